@@ -1,6 +1,13 @@
+import os
+import json
+import time
 import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 
 import datajoint as dj
+from datajoint.blob import pack as pack_blob
 from datetime import datetime
 import hashlib
 import numpy as np
@@ -11,6 +18,10 @@ log = logging.getLogger(__name__)
 if 'custom' not in dj.config:
     dj.config['custom'] = {}
 
+# custom settings passed down to child processes (which re-read the configuration files) - e.g. schema names
+if os.environ.get('PIPELINE_CUSTOM_CONFIG'):
+    dj.config['custom'] = {**dj.config['custom'], **json.loads(os.environ['PIPELINE_CUSTOM_CONFIG'])}
+
 datetime_formats = ('%Y%m%d %H%M%S', '%Y%m%d')
 
 time_unit_conversion_factor = {'millisecond': 1e-3,
@@ -41,50 +52,229 @@ def get_schema_name(name):
     return prefix + name
 
 
+def _row_bytes(row):
+    """
+    Estimated payload size of one row (dict or sequence of attribute values), in bytes
+    """
+    values = row.values() if isinstance(row, dict) else row
+    return sum(v.nbytes if isinstance(v, np.ndarray) else len(v) if isinstance(v, (str, bytes)) else 8
+               for v in values)
+
+
+_flush_executor = None
+
+
+def _serialize_queries(connection):
+    """
+    Serialize all the queries of `connection` behind a lock: pymysql connections are not thread-safe, and background
+    flushes share the caller's connection (and its transaction) while the caller keeps querying,
+    e.g. the lazy heading loads. The queries are buffered (cursors hold their results), so locking `query` suffices.
+    """
+    if getattr(connection.query, '_query_lock', None) is None:  # not wrapped, or the wrapper was since replaced
+        lock = getattr(connection, '_query_lock', None) or threading.RLock()
+        query = connection.query
+
+        def locked_query(*args, **kwargs):
+            with lock:
+                return query(*args, **kwargs)
+
+        locked_query._query_lock = lock
+        connection.query = locked_query
+        connection._query_lock = lock
+
+
+def _get_flush_executor():
+    # one shared thread: background flushes are run in submission order
+    global _flush_executor
+    if _flush_executor is None:
+        _flush_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='InsertBuffer')
+    return _flush_executor
+
+
 class InsertBuffer(object):
     '''
     InsertBuffer: a utility class to help managed chunked inserts
 
-    Currently requires records do not have prerequisites.
+    Rows are flushed (inserted) once the buffer holds `chunksz` rows or an estimated `max_bytes` of payload,
+    bounding both the memory held by the buffer and the size of each insert query.
+    With `background=True`, flushes run on a background thread while the caller keeps producing rows; at most one
+    flush per buffer is in flight. The flushes share the caller's connection - within its transaction - and the
+    queries of the connection are serialized behind a lock, so the caller may keep querying meanwhile.
+    `upstream` buffers (e.g. of parent tables) are flushed before this buffer's rows, so foreign keys hold.
+
+    Flush statistics are accumulated in `stats`: flushes, rows, bytes, seconds (spent inserting).
+
+    Currently requires records do not have prerequisites other than `upstream` buffers.
     '''
-    def __init__(self, rel, chunksz=1, **insert_args):
+    def __init__(self, rel, chunksz=1000, max_bytes=2**25, background=False, upstream=(), **insert_args):
         self._rel = rel
         self._queue = []
+        self._queue_bytes = 0
         self._chunksz = chunksz
+        self._max_bytes = max_bytes
+        self._background = background
+        self._upstream = list(upstream)
+        self._pending = None
         self._insert_args = insert_args
+        if background:
+            _serialize_queries((rel() if isinstance(rel, type) else rel).connection)
+        self.stats = dict(flushes=0, rows=0, bytes=0, seconds=0.)
 
     def insert1(self, r):
         self._queue.append(r)
+        self._queue_bytes += _row_bytes(r)
+        if self._is_full():
+            self.flush(1)
 
     def insert(self, recs):
-        self._queue += recs
+        for r in recs:
+            self.insert1(r)
+
+    def _is_full(self):
+        return len(self._queue) >= self._chunksz or (self._max_bytes and self._queue_bytes >= self._max_bytes)
+
+    def _write(self, rows):
+        self._rel.insert(rows, **self._insert_args)
+
+    def _insert(self, rows, nbytes):
+        start = time.time()
+        self._write(rows)
+        self.stats['flushes'] += 1
+        self.stats['rows'] += len(rows)
+        self.stats['bytes'] += nbytes
+        self.stats['seconds'] += time.time() - start
 
     def flush(self, chunksz=None):
         '''
-        flush the buffer
+        flush the buffer - if it holds at least `chunksz` rows (default: the buffer's chunksz)
+        :return: number of rows flushed (submitted, for a background flush)
         XXX: also get pymysql.err.DataError, etc - catch these or pr datajoint?
-        XXX: optional flush-on-error? hmm..
         '''
         qlen = len(self._queue)
         if chunksz is None:
             chunksz = self._chunksz
 
-        if qlen > 0 and qlen % chunksz == 0:
-            try:
-                self._rel.insert(self._queue, **self._insert_args)
-                self._queue.clear()
-                return qlen
-            except dj.DataJointError as e:
-                raise
+        if qlen > 0 and qlen >= chunksz:
+            for buffer in self._upstream:
+                buffer.flush(1)
+            rows, nbytes = self._queue, self._queue_bytes
+            self._queue, self._queue_bytes = [], 0
+            if self._background:
+                self.wait()  # at most one flush in flight - bounds the memory of pending rows
+                self._pending = _get_flush_executor().submit(self._insert, rows, nbytes)
+            else:
+                self._insert(rows, nbytes)
+            return qlen
+
+    def wait(self):
+        '''
+        wait for the pending background flush, re-raising its error if any
+        '''
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
 
     def __enter__(self):
         return self
 
     def __exit__(self, etype, evalue, etraceback):
         if etype:
+            if self._pending is not None:
+                self._pending.cancel()
+                wait_futures([self._pending])
+                self._pending = None
             raise evalue
         else:
-            return self.flush(1)
+            qlen = self.flush(1)
+            self.wait()
+            return qlen
+
+
+ColumnarRows = namedtuple('ColumnarRows', ['keys', 'columns'])
+ColumnarRows.__doc__ = '''
+Rows of a table in columnar form: `keys` - {attribute: value shared by all rows},
+`columns` - {attribute: per-row values}, e.g. an array, or a list of arrays for a blob attribute
+'''
+
+_pack_executor = None
+
+
+def _get_pack_executor():
+    # blob compression (zlib) releases the GIL - blobs are packed in parallel threads
+    global _pack_executor
+    if _pack_executor is None:
+        _pack_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='BlobPack')
+    return _pack_executor
+
+
+class BulkInsertBuffer(InsertBuffer):
+    '''
+    BulkInsertBuffer: an InsertBuffer of ColumnarRows, bypassing DataJoint's per-row insert path
+
+    The blobs are packed as the rows are buffered (in a thread pool), and each flush writes its rows with one
+    multi-row INSERT statement. The attributes are validated against the table's heading (once per column, not
+    per row): unknown attributes, missing primary key attributes and NULLs in non-nullable attributes are errors.
+    With `skip_duplicates`, only the rows of existing primary keys are skipped - as `Table.insert` does.
+    '''
+    def __init__(self, rel, chunksz=5000, max_bytes=2**24, background=False, upstream=(), skip_duplicates=False,
+                 **insert_args):
+        rel = rel() if isinstance(rel, type) else rel
+        super().__init__(rel, chunksz=chunksz, max_bytes=max_bytes, background=background, upstream=upstream)
+        self._skip_duplicates = skip_duplicates
+        self._attributes = None
+
+    def insert(self, recs):
+        if not isinstance(recs, ColumnarRows):
+            raise dj.DataJointError('BulkInsertBuffer only inserts ColumnarRows')
+        self.insert_columns(recs.keys, recs.columns)
+
+    def insert_columns(self, keys, columns):
+        heading = self._rel.heading
+        attributes = [*keys, *columns]
+        unknown = [a for a in attributes if a not in heading.names]
+        if unknown:
+            raise dj.DataJointError(f'Attributes not in {self._rel.full_table_name}: {unknown}')
+        missing = [a for a in heading.primary_key if a not in attributes]
+        if missing:
+            raise dj.DataJointError(f'Missing primary key attributes of {self._rel.full_table_name}: {missing}')
+        if self._attributes is None:
+            self._attributes = attributes
+        elif attributes != self._attributes:
+            raise dj.DataJointError(f'Inconsistent attributes for {self._rel.full_table_name}: {attributes}')
+
+        row_count = len(next(iter(columns.values())))
+        values = []
+        for attr in attributes:
+            if attr in columns:
+                column = columns[attr]
+                if heading.attributes[attr].is_blob:
+                    column = list(_get_pack_executor().map(pack_blob, column))
+                else:
+                    column = np.asarray(column)
+                    is_null = np.isnan(column) if column.dtype.kind == 'f' else np.zeros(len(column), bool)
+                    if is_null.any() and not heading.attributes[attr].nullable:
+                        raise dj.DataJointError(f'NULL values for the non-nullable {attr} '
+                                                f'of {self._rel.full_table_name}')
+                    # python scalars for the database driver - NaN as NULL
+                    column = [None if null else v for v, null in zip(column.tolist(), is_null)]
+            else:
+                value = keys[attr]
+                if value is None and not heading.attributes[attr].nullable:
+                    raise dj.DataJointError(f'NULL value for the non-nullable {attr} of {self._rel.full_table_name}')
+                column = [value.item() if isinstance(value, np.generic) else value] * row_count
+            values.append(column)
+        super().insert(zip(*values))
+
+    def _write(self, rows):
+        placeholders = '({})'.format(','.join(['%s'] * len(self._attributes)))
+        # skip the duplicates as Table.insert does - unlike INSERT IGNORE, other errors (e.g. foreign keys) still raise
+        sql = 'INSERT INTO {table} ({fields}) VALUES {values}{duplicate}'.format(
+            table=self._rel.full_table_name,
+            fields=','.join('`{}`'.format(a) for a in self._attributes),
+            values=','.join([placeholders] * len(rows)),
+            duplicate=(' ON DUPLICATE KEY UPDATE `{pk}`={table}.`{pk}`'.format(
+                table=self._rel.full_table_name, pk=self._rel.primary_key[0]) if self._skip_duplicates else ''))
+        self._rel.connection.query(sql, args=tuple(v for row in rows for v in row))
 
 
 def dict_to_hash(key):
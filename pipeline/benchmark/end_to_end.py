@@ -0,0 +1,172 @@
+'''
+End-to-end benchmark of the pipeline on a synthetic dataset (see `synthetic.py`):
+metadata ingestion -> data ingestion -> each populate of `ingest/populate.py` -> `compute_CD_projected_psth` -> NWB export
+
+Runs against the database configured in dj.config - e.g. a local MySQL container:
+    docker run -d -p 3306:3306 -e MYSQL_ROOT_PASSWORD=simple datajoint/mysql
+All schemas are created under their own prefix (`--prefix`, default "bench_"), dropped at the end unless `--keep`.
+
+For each step, the wall time, the rows inserted per table (and rows/s), and the peak memory so far (cumulative -
+the largest of this process and its workers since the start; `--trace-memory` adds the step's own peak) are reported;
+the results are written as JSON (`--output`), tagged with the git commit, to track regressions across commits.
+'''
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import json
+import time
+import pathlib
+import argparse
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import importlib
+from datetime import datetime
+
+import datajoint as dj
+
+benchmark_tables = {'experiment': ['Session', 'SessionTrial', 'BehaviorTrial', 'TrialEvent', 'PhotostimTrial',
+                                   'PhotostimEvent', 'PhotostimTrace', 'PhotostimBrainRegion'],
+                    'tracking': ['LickTrace'],
+                    'ephys': ['Unit', 'UnitCellType', 'TrialSpikes'],
+                    'psth': ['TrialConditionMembership', 'UnitPsth', 'PeriodSelectivity', 'UnitSelectivity']}
+
+
+def configure_schemas(prefix):
+    '''
+    Create all schemas under `prefix` - must run before importing the pipeline,
+    whose schema names are fixed at import. The settings are also passed to the worker processes, through the
+    environment (they re-read the configuration files).
+    '''
+    if 'pipeline' in sys.modules:
+        raise RuntimeError('The pipeline is already imported - its schemas would not be under the prefix {}: '
+                           'run the benchmark as a script'.format(prefix))
+    custom = {'database.prefix': prefix}
+    dj.config['custom'] = {**dj.config.get('custom', {}), **custom}
+    os.environ['PIPELINE_CUSTOM_CONFIG'] = json.dumps(custom)
+
+
+def drop_schemas(schemas, prefix):
+    '''
+    Drop the benchmark schemas - refusing to drop any schema outside of `prefix`
+    '''
+    for schema in schemas:
+        if not schema.database.startswith(prefix):
+            raise RuntimeError(f'Not dropping {schema.database}: not a benchmark schema (prefix {prefix})')
+    for schema in schemas:
+        schema.drop(force=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cumulative_peak_rss_mb():
+    '''
+    Peak RSS since the benchmark started - not per step: the largest of this process and of its terminated worker
+    processes (ru_maxrss of RUSAGE_CHILDREN is the peak of the largest child, not a sum), in MB (kB on Linux)
+    '''
+    return max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) / 1024
+
+
+class Benchmark:
+    '''
+    Run and time the steps of the benchmark, counting the rows of the benchmark tables before and after each step
+    '''
+    def __init__(self, tables, trace_memory=False):
+        self.tables = tables
+        self.trace_memory = trace_memory
+        self.steps = []
+
+    def row_counts(self):
+        return {name: len(table()) for name, table in self.tables.items()}
+
+    def run(self, name, func, *args, **kwargs):
+        print(f'==================== {name} ====================')
+        counts = self.row_counts()
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        result = func(*args, **kwargs)
+        duration = time.time() - start
+        traced_peak = tracemalloc.get_traced_memory()[1] / 1e6 if self.trace_memory else None
+        if self.trace_memory:
+            tracemalloc.stop()
+
+        inserted = {table: count - counts[table] for table, count in self.row_counts().items()
+                    if count != counts[table]}
+        step = dict(step=name, duration=duration,
+                    cumulative_peak_rss_mb=cumulative_peak_rss_mb(), traced_peak_mb=traced_peak,
+                    rows=inserted, rows_per_second={table: rows / duration for table, rows in inserted.items()})
+        print(f'{name}: {duration:.2f} s - peak RSS so far {step["cumulative_peak_rss_mb"]:.0f} MB')
+        for table, rows in inserted.items():
+            print(f'\t{table:>20}: {rows:8d} rows - {step["rows_per_second"][table]:10.1f} rows/s')
+        self.steps.append(step)
+        return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the pipeline on a synthetic dataset')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    parser.add_argument('--prefix', default='bench_', help='prefix of the benchmark schemas')
+    parser.add_argument('--data-dir', default=None,
+                        help='existing synthetic dataset (meta_data and data_structure directories)')
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--trials', type=int, default=300)
+    parser.add_argument('--units', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=1, help='data ingestion workers')
+    parser.add_argument('--trace-memory', action='store_true', help='also report the tracemalloc peak of each step')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark schemas')
+    args = parser.parse_args(args)
+
+    configure_schemas(args.prefix)
+
+    from pipeline import lab, experiment, ephys, tracking, psth, virus
+    from pipeline.ingest import status
+    from pipeline.benchmark import synthetic
+    from pipeline.ingest import ingest_meta_Li_2015, ingest_data_Li_2015, populate
+    from pipeline.export.datajoint_to_nwb import export_to_nwb
+
+    modules = dict(experiment=experiment, tracking=tracking, ephys=ephys, psth=psth)
+    tables = {name: getattr(modules[module], name) for module, names in benchmark_tables.items() for name in names}
+    benchmark = Benchmark(tables, trace_memory=args.trace_memory)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = pathlib.Path(args.data_dir or tmp_dir)
+        if not args.data_dir:
+            benchmark.run('generate', synthetic.write_dataset, data_dir, session_count=args.sessions,
+                          trial_count=args.trials, unit_count=args.units)
+
+        try:
+            benchmark.run('insert_lookup', importlib.import_module, 'pipeline.ingest.insert_lookup')
+            benchmark.run('ingest_meta', ingest_meta_Li_2015.main, data_dir / 'meta_data')
+            benchmark.run('ingest_data', ingest_data_Li_2015.main, data_dir / 'data_structure', workers=args.workers)
+
+            for table in populate.tables:
+                benchmark.run(f'populate {table.__name__}', table.populate, **populate.settings)
+
+            session_keys = experiment.Session.fetch('KEY')
+            benchmark.run('compute_CD_projected_psth', lambda: [
+                psth.compute_CD_projected_psth((ephys.Unit & key).fetch('KEY')) for key in session_keys])
+            benchmark.run('export_to_nwb', lambda: [
+                export_to_nwb(key, nwb_output_dir=tmp_dir, save=True, overwrite=True) for key in session_keys])
+        finally:
+            if not args.keep:
+                drop_schemas((psth.schema, tracking.schema, ephys.schema, status.schema, experiment.schema,
+                              virus.schema, lab.schema), args.prefix)
+
+    results = dict(commit=git_commit(), time=datetime.now().isoformat(), parameters=vars(args),
+                   total_duration=sum(step['duration'] for step in benchmark.steps), steps=benchmark.steps)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+'''
+Benchmark of the psth computation of `psth.py`:
+one np.histogram per trial / per unit (the former `compute_unit_psth` and `UnitPsth.compute_psth`)
+vs. a single searchsorted/bincount pass over ragged spike times (`compute_psths`, `spike_histograms`)
+on a synthetic 500-trial, 100-unit session
+'''
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import time
+import numpy as np
+
+from pipeline.psth_engine import RaggedSpikes, psth_bin_edges, bin_spikes, spike_histograms, compute_psths
+
+psth_params = {'xmin': -3, 'xmax': 3, 'binsize': 0.04}
+
+
+def make_trial_spikes(trial_count=500, unit_count=100, firing_rate=10, trial_duration=6, seed=0):
+    """
+    Synthetic TrialSpikes: per unit, the list of the spike times of each trial (aligned to the go cue)
+    """
+    rng = np.random.RandomState(seed)
+    return [[np.sort(rng.uniform(-trial_duration / 2, trial_duration / 2, count))
+             for count in rng.poisson(firing_rate * trial_duration, trial_count)]
+            for _ in range(unit_count)]
+
+
+def histogram_per_trial(unit_spikes, xmin, xmax, binsize):
+    binning = np.arange(xmin, xmax, binsize)
+    return [np.vstack([np.histogram(spike, bins=binning)[0] / binsize for spike in spikes])
+            for spikes in unit_spikes]
+
+
+def histogram_per_unit(unit_spikes, xmin, xmax, binsize):
+    binning = np.arange(xmin, xmax, binsize)
+    return [np.histogram(np.concatenate(spikes), bins=binning)[0] / len(spikes) / binsize
+            for spikes in unit_spikes]
+
+
+def engine_per_trial(unit_spikes, xmin, xmax, binsize):
+    return [compute_psths(RaggedSpikes.from_rows(spikes), xmin, xmax, binsize, per_trial=True)[0]
+            for spikes in unit_spikes]
+
+
+def engine_per_unit(unit_spikes, xmin, xmax, binsize):
+    # all units in one pass - as UnitPsth.make over a session
+    spikes = RaggedSpikes.from_rows([s for unit in unit_spikes for s in unit])
+    row_units = np.repeat(np.arange(len(unit_spikes)), [len(unit) for unit in unit_spikes])
+    edges = psth_bin_edges(xmin, xmax, binsize)
+    rows, bins = bin_spikes(spikes, edges)
+    counts = spike_histograms(row_units[rows], bins, len(edges) - 1, len(unit_spikes))
+    return list(counts / np.bincount(row_units)[:, None] / binsize)
+
+
+def main(trial_count=500, unit_count=100):
+    unit_spikes = make_trial_spikes(trial_count, unit_count)
+    print(f'{unit_count} units - {trial_count} trials - '
+          f'{sum(len(s) for unit in unit_spikes for s in unit)} spikes')
+
+    timings = {}
+    for name, func in (('histogram per trial', histogram_per_trial), ('engine per trial', engine_per_trial),
+                       ('histogram per unit', histogram_per_unit), ('engine per unit', engine_per_unit)):
+        start = time.time()
+        results = func(unit_spikes, **psth_params)
+        timings[name] = time.time() - start
+        print(f'{name:>20}: {timings[name]:.3f} s')
+
+        # sanity check - the engine yields the same psths as np.histogram
+        if name.startswith('engine'):
+            expected = (histogram_per_trial if 'trial' in name else histogram_per_unit)(unit_spikes, **psth_params)
+            assert all(np.allclose(r, e) for r, e in zip(results, expected))
+
+    print(f'speedup per trial: {timings["histogram per trial"] / timings["engine per trial"]:.1f}x - '
+          f'per unit: {timings["histogram per unit"] / timings["engine per unit"]:.1f}x')
+    return timings
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+'''
+Generator of synthetic datasets in the layout of the CRCNS alm-1 (li2015) / alm-3 (lidaie2016) downloads:
+one `meta_data` .mat file and one `data_structure` .mat file (`obj` structure) per session,
+readable by the `ingest_meta_*` and `ingest_data_*` scripts - to benchmark and load-test the pipeline at any scale
+
+e.g. 10x the li2015 dataset:
+    python pipeline/benchmark/synthetic.py ./data/synthetic --sessions 250 --trials 400 --units 40
+'''
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import argparse
+import pathlib
+from datetime import date, timedelta
+
+import numpy as np
+import scipy.io as sio
+
+trial_type_str = ['HitR', 'HitL', 'ErrR', 'ErrL', 'NoLickR', 'NoLickL']
+
+# {dataset: (photostim locations of the meta data, photostim types of the trials, photostim duration per type)}
+photostim_layouts = {
+    'li2015': ([('PONS', (-4.0, 0.6, 5.0)), ('ALM', (2.5, -1.5, 0.0))],
+               [1, 2],
+               {1: 1.3, 2: 1.3}),
+    'lidaie2016': ([('ALM', (2.5, -1.5, 0.0)), ('ALM', (2.5, 1.5, 0.0))],
+                   [1, 2, 3, 4, 5, 7],
+                   {1: 0.5, 2: 0.5, 3: 0.5, 4: 0.8, 5: 0.8, 6: 0.8, 7: 0.8, 8: 0.8, 9: 0.8})}
+
+time_unit_names = ['millisecond', 'second']  # the 1-based `timeUnit` index 2 -> second
+
+sample_dur, delay_dur, post_go_dur, inter_trial_dur = 1.3, 1.7, 2., 1.
+waveform_samples = 29
+
+
+def _cell(values):
+    '''
+    MATLAB cell array of `values`
+    '''
+    cell = np.empty(len(values), dtype=object)
+    for idx, value in enumerate(values):
+        cell[idx] = value
+    return cell
+
+
+def _struct_array(records):
+    '''
+    MATLAB struct array of `records` (list of dicts with the same keys)
+    '''
+    struct = np.empty(len(records), dtype=[(field, object) for field in records[0]])
+    for idx, record in enumerate(records):
+        for field, value in record.items():
+            struct[field][idx] = value
+    return struct
+
+
+def make_meta(subject_id, session_date, dataset='li2015'):
+    '''
+    Synthetic `meta_data` structure of one session
+    '''
+    photostim_locations, _, _ = photostim_layouts[dataset]
+    shank, site = np.meshgrid(np.arange(4), np.arange(8), indexing='ij')
+    site_locations = np.column_stack([2.5 + shank.ravel() * 0.2,               # ap (mm)
+                                      np.full(32, -1.5),                         # ml (mm)
+                                      0.8 - site.ravel() * 0.1]).astype(float)  # dv (mm)
+    return dict(experimenters='NL',
+                animalGeneModification='Sim1-Cre',
+                animalStrain='kj18',
+                animalID=f'ANM{subject_id}',
+                animalSource='Jackson Labs',
+                sex='M',
+                species='Mus musculus',
+                dateOfBirth=(session_date - timedelta(days=120)).strftime('%Y%m%d'),
+                dateOfExperiment=session_date.strftime('%Y%m%d'),
+                timeOfExperiment='120000',
+                extracellular=dict(recordingLocation='ALM',
+                                   recordingCoordinates=np.array([2.5, 1.5, 800.]),  # mm, mm, um
+                                   siteLocations=site_locations),
+                photostim=dict(photostimLocation=_cell([loc for loc, _ in photostim_locations]),
+                               photostimCoordinates=np.array([coord for _, coord in photostim_locations]),
+                               photostimWavelength=473))
+
+
+def make_session(dataset='li2015', trial_count=300, unit_count=30, firing_rate=10., photostim_fraction=0.3,
+                 ts_rate=100, seed=0):
+    '''
+    Synthetic `obj` structure of one session
+    :param firing_rate: mean firing rate of the units (Hz) - each unit's rate is drawn around it
+    :param photostim_fraction: fraction of photostim trials, their types drawn from the dataset's photostim types
+    :param ts_rate: sampling rate (Hz) of the lick / laser time-series
+    '''
+    rng = np.random.RandomState(seed)
+    _, photostim_types, photostim_durations = photostim_layouts[dataset]
+
+    # ---- trials ----
+    trial_ids = np.arange(1, trial_count + 1)
+    sample_start = 0.5 + rng.uniform(0, 0.1, trial_count)
+    delay_start = sample_start + sample_dur
+    response_start = delay_start + delay_dur
+    trial_durations = response_start + post_go_dur
+    trial_start_times = np.r_[0, np.cumsum(trial_durations + inter_trial_dur)[:-1]]
+
+    trial_types = rng.choice(len(trial_type_str), trial_count, p=[0.35, 0.35, 0.1, 0.1, 0.05, 0.05])
+    trial_type_mat = np.zeros((7, trial_count))
+    trial_type_mat[trial_types, np.arange(trial_count)] = 1
+    trial_type_mat[6, :] = rng.uniform(size=trial_count) < 0.05  # early lick
+    is_right = np.isin(trial_types, [0, 2, 4])
+
+    photostim_type = np.where(rng.uniform(size=trial_count) < photostim_fraction,
+                              rng.choice(photostim_types, trial_count), 0)
+
+    # ---- time-series: lick, AOM input, laser power ----
+    ts_trials = [np.full(int(dur * ts_rate), tr) for tr, dur in zip(trial_ids, trial_durations)]
+    ts_time = np.concatenate([start + np.arange(len(tr_samples)) / ts_rate
+                              for start, tr_samples in zip(trial_start_times, ts_trials)])
+    ts_trial = np.concatenate(ts_trials)
+    ts_rel_time = ts_time - trial_start_times[ts_trial - 1]
+    lick = (rng.uniform(size=len(ts_time)) < 0.02).astype(float)
+    stim_dur = np.array([photostim_durations.get(t, 0) for t in photostim_type])
+    is_stim = ((photostim_type[ts_trial - 1] > 0)
+               & (ts_rel_time >= delay_start[ts_trial - 1])
+               & (ts_rel_time < delay_start[ts_trial - 1] + stim_dur[ts_trial - 1]))
+    aom_input = np.where(is_stim, 5., 0.)
+    laser_power = np.where(is_stim, 1.5, 0.)
+
+    # ---- units ----
+    units = []
+    unit_rates = rng.lognormal(np.log(firing_rate), 0.5, unit_count)
+    for unit_idx, unit_rate in enumerate(unit_rates):
+        # half of the units are selective: firing more during right trials
+        tr_rates = unit_rate * np.where(is_right & (unit_idx % 2 == 0), 1.5, 1.)
+        spike_counts = rng.poisson(tr_rates * trial_durations)
+        event_trials = np.repeat(trial_ids, spike_counts)
+        event_times = (trial_start_times[event_trials - 1]
+                       + rng.uniform(0, 1, len(event_trials)) * trial_durations[event_trials - 1])
+        order = np.argsort(event_times, kind='stable')
+        cell_type = 'FS' if unit_idx % 5 == 0 else ('pyramidal' if unit_idx % 3 else _cell(['pyramidal', 'IT']))
+        units.append(dict(eventTimes=event_times[order],
+                          eventTrials=event_trials[order].astype(float),
+                          channel=np.full(len(event_times), rng.randint(1, 33), dtype=float),
+                          waveforms=-np.exp(-((np.arange(waveform_samples) - 8) / 3.) ** 2) * rng.uniform(50, 150),
+                          cellType=cell_type,
+                          timeUnit=2))
+
+    return dict(timeUnitNames=_cell(time_unit_names),
+                trialIds=trial_ids.astype(float),
+                trialStartTimes=trial_start_times,
+                trialTimeUnit=2,
+                trialTypeMat=trial_type_mat,
+                trialTypeStr=_cell(trial_type_str + ['StimTrials']),
+                trialPropertiesHash=dict(
+                    keyNames=_cell(['SampleTime', 'DelayTime', 'CueTime', 'PhotostimulationType']),
+                    value=_cell([sample_start, delay_start, response_start, photostim_type.astype(float)])),
+                timeSeriesArrayHash=dict(
+                    keyNames=_cell(['EphusVariables']),
+                    value=dict(time=ts_time, timeUnit=2, trial=ts_trial.astype(float),
+                               idStr=_cell(['lick', 'aom', 'laser_power']),
+                               valueMatrix=np.column_stack([lick, aom_input, laser_power]))),
+                eventSeriesHash=dict(keyNames=_cell([f'cell {idx + 1}' for idx in range(unit_count)]),
+                                     value=_struct_array(units)))
+
+
+def write_dataset(out_dir, dataset='li2015', session_count=10, subject_count=None, trial_count=300, unit_count=30,
+                  firing_rate=10., photostim_fraction=0.3, seed=0):
+    '''
+    Write a synthetic dataset: `out_dir`/meta_data and `out_dir`/data_structure, one .mat file per session in each
+    :param subject_count: number of subjects the sessions are spread over (default: one session per subject)
+    :return: list of (meta data file, data_structure file)
+    '''
+    out_dir = pathlib.Path(out_dir)
+    (out_dir / 'meta_data').mkdir(parents=True, exist_ok=True)
+    (out_dir / 'data_structure').mkdir(parents=True, exist_ok=True)
+    subject_count = subject_count or session_count
+
+    files = []
+    for sess_idx in range(session_count):
+        subject_id = 900000 + sess_idx % subject_count
+        session_date = date(2014, 1, 1) + timedelta(days=sess_idx // subject_count)
+        fname = f'ANM{subject_id}_{session_date.strftime("%Y%m%d")}.mat'
+
+        meta_file = out_dir / 'meta_data' / f'meta_data_{fname}'
+        sio.savemat(meta_file, {'meta_data': make_meta(subject_id, session_date, dataset)})
+        data_file = out_dir / 'data_structure' / f'data_structure_{fname}'
+        sio.savemat(data_file, {'obj': make_session(dataset, trial_count, unit_count, firing_rate,
+                                                    photostim_fraction, seed=seed + sess_idx)})
+        print(f'\t{sess_idx + 1}/{session_count}: {data_file}')
+        files.append((meta_file, data_file))
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic dataset of meta_data and data_structure files')
+    parser.add_argument('out_dir')
+    parser.add_argument('--dataset', choices=sorted(photostim_layouts), default='li2015')
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--subjects', type=int, default=None)
+    parser.add_argument('--trials', type=int, default=300, help='trials per session')
+    parser.add_argument('--units', type=int, default=30, help='units per session')
+    parser.add_argument('--firing-rate', type=float, default=10., help='mean firing rate of the units (Hz)')
+    parser.add_argument('--photostim-fraction', type=float, default=0.3, help='fraction of photostim trials')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_dataset(args.out_dir, dataset=args.dataset, session_count=args.sessions, subject_count=args.subjects,
+                  trial_count=args.trials, unit_count=args.units, firing_rate=args.firing_rate,
+                  photostim_fraction=args.photostim_fraction, seed=args.seed)
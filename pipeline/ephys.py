@@ -2,7 +2,7 @@
 import datajoint as dj
 
 from . import lab, experiment
-from . import get_schema_name
+from . import get_schema_name, InsertBuffer
 
 import numpy as np
 
@@ -185,12 +185,12 @@ class UnitStat(dj.Computed):
     key_source = ProbeInsertion & experiment.SessionTrial.proj() - (experiment.SessionTrial * Unit - TrialSpikes.proj())
 
     def make(self, key):
-        def make_insert():
+        # stream the unit stats through a bounded buffer - not in the background, the loop queries the database
+        with InsertBuffer(self, chunksz=100) as unit_stats:
             for unit in (Unit & key).fetch('KEY'):
                 trial_spikes, tr_start, tr_stop = (TrialSpikes * experiment.SessionTrial & unit).fetch(
                     'spike_times', 'start_time', 'stop_time')
                 isi = np.hstack(np.diff(spks) for spks in trial_spikes)
-                yield {**unit,
-                       'isi_violation': sum((isi < self.isi_violation_thresh).astype(int)) / len(isi) if isi.size else None,
-                       'avg_firing_rate': len(np.hstack(trial_spikes)) / sum(tr_stop - tr_start) if isi.size else None}
-        self.insert(make_insert())
+                unit_stats.insert1({**unit,
+                                    'isi_violation': sum((isi < self.isi_violation_thresh).astype(int)) / len(isi) if isi.size else None,
+                                    'avg_firing_rate': len(np.hstack(trial_spikes)) / sum(tr_stop - tr_start) if isi.size else None})
@@ -0,0 +1,442 @@
+'''
+Ingestion engine of the session data_structure .mat files, shared by the two papers
+
+The dataset-specific rules (project, photostim types, trial stop time) are supplied by a `DatasetProfile`,
+see `ingest_data_Li_2015.py` and `ingest_data_Li_Daie_2016.py`
+'''
+
+import re
+import abc
+import argparse
+import pathlib
+from functools import partial
+from contextlib import ExitStack
+
+from tqdm import tqdm
+import numpy as np
+
+from pipeline import experiment, ephys, tracking
+from pipeline import parse_date, InsertBuffer, BulkInsertBuffer, ColumnarRows
+from pipeline.ingest.util import (run_sessions, run_pipelined, split_by_trial, trial_slices, QueryCounter,
+                                  SessionTiming, cprofiled, log_to_file)
+from pipeline.ingest.session_cache import load_session
+from pipeline.ingest import status
+
+
+insert_kwargs = {'ignore_extra_fields': True, 'allow_direct_insert': True, 'skip_duplicates': True}
+
+
+class DatasetProfile(abc.ABC):
+    '''
+    Dataset-specific mapping tables and trial rules of the session data ingestion
+    '''
+
+    project_name = None
+
+    # {photostim type (from trialPropertiesHash): photostim details}
+    photostim_mapper = {}
+
+    session_suffixes = ['a', 'b', 'c', 'd', 'e']
+
+    trial_type_str = ['HitR', 'HitL', 'ErrR', 'ErrL', 'NoLickR', 'NoLickL']
+    trial_type_mapper = {'HitR': ('hit', 'right'),
+                         'HitL': ('hit', 'left'),
+                         'ErrR': ('miss', 'right'),
+                         'ErrL': ('miss', 'left'),
+                         'NoLickR': ('ignore', 'right'),
+                         'NoLickL': ('ignore', 'left')}
+
+    cell_type_mapper = {'pyramidal': 'Pyr', 'FS': 'FS', 'IT': 'IT', 'PT': 'PT'}
+
+    post_resp_tlim = 2  # a trial may last at most 2 seconds after response cue
+
+    task_protocol = {'task': 'audio delay', 'task_protocol': 1}
+
+    clustering_method = 'manual'
+
+    def trial_stop_time(self, tr_start, response_start):
+        # element-wise - over the arrays of all trials of the session
+        return tr_start + response_start + self.post_resp_tlim
+
+    @abc.abstractmethod
+    def photostim_restriction(self, photostim_type):
+        '''
+        Restriction on `Photostim * PhotostimBrainRegion` identifying the Photostim of this photostim type
+        '''
+
+    @abc.abstractmethod
+    def photostim_event(self, photostim_type, delay_start, response_start):
+        '''
+        PhotostimEvent attributes specific to this photostim type (e.g. event time, duration)
+        '''
+
+
+def _casefold(value):
+    # string comparisons of the restrictions are case-insensitive - as in MySQL, e.g. 'alm' matches 'ALM'
+    return value.casefold() if isinstance(value, str) else value
+
+
+def get_photostim_keys(photostims, profile):
+    """
+    Resolve the Photostim key of each photostim type of the `profile`, for one session
+    :return: dict of {photostim type: Photostim key, or None if not found}
+    """
+    photostim_locs = photostims.proj('stim_brain_area', 'stim_laterality').fetch(as_dict=True)
+    photostim_keys = {}
+    for photostim_type in profile.photostim_mapper:
+        restriction = profile.photostim_restriction(photostim_type)
+        matched = [{k: p[k] for k in photostims.primary_key} for p in photostim_locs
+                   if all(_casefold(p[k]) == _casefold(v) for k, v in restriction.items())]
+        if len(matched) > 1:
+            raise ValueError(f'Multiple photostims found for {restriction}')
+        photostim_keys[photostim_type] = matched[0] if matched else None
+    return photostim_keys
+
+
+def _cprofile_dump_file(data_file, cprofile_session, cprofile_dir):
+    if cprofile_session and cprofile_session in data_file.stem:
+        return pathlib.Path(cprofile_dir) / f'{data_file.stem}.prof'
+
+
+def ingest_session(data_file, profile, cprofile_session=None, cprofile_dir='.'):
+    """
+    Ingest the trial, photostim, lick and unit data of one session .mat file
+    :param cprofile_session: run the ingestion of the session(s) whose file name contains this string under cProfile,
+        dumping the stats to `cprofile_dir`/<file name>.prof
+    :return: dict of the `stages` timings (see SessionTiming) if the session is ingested,
+        False if it was already ingested
+    """
+    print(f'-- Read {data_file} --')
+
+    timing = SessionTiming()
+    with cprofiled(_cprofile_dump_file(data_file, cprofile_session, cprofile_dir)), \
+            QueryCounter(experiment.Session.connection) as query_counter:
+        with timing.stage('match'):
+            session_key, stages = match_session(data_file, profile)
+        if stages:
+            with timing.stage('load'):
+                sess_data = load_session(data_file)
+            with sess_data:
+                with timing.stage('read_trials'):
+                    trials = read_trials(sess_data, profile)
+                for stage in stages:
+                    with timing.stage(stage) as stage_timing:
+                        stage_timing['tables'] = insert_stage(
+                            session_key, stage, stage_rows[stage](session_key, sess_data, trials, profile), data_file)
+    print(f'\tDatabase round-trips: {query_counter.count}')
+    return dict(stages=timing.stages) if stages else False
+
+
+def parse_session(data_file, profile, cprofile_session=None, cprofile_dir='.'):
+    """
+    Read one session .mat file into the rows of its incomplete ingestion stages - without inserting them
+    :return: (data_file, session_key, [(stage, [(table, rows)])], stage timings) -
+        None if the session is already ingested
+    """
+    print(f'-- Read {data_file} --')
+
+    timing = SessionTiming()
+    with cprofiled(_cprofile_dump_file(data_file, cprofile_session, cprofile_dir)):
+        with timing.stage('match'):
+            session_key, stages = match_session(data_file, profile)
+        if not stages:
+            return None
+        with timing.stage('load'):
+            sess_data = load_session(data_file)
+        with sess_data:
+            with timing.stage('read_trials'):
+                trials = read_trials(sess_data, profile)
+            parsed_stages = []
+            for stage in stages:
+                with timing.stage(f'{stage} rows'):
+                    parsed_stages.append((stage, list(stage_rows[stage](session_key, sess_data, trials, profile))))
+    return data_file, session_key, parsed_stages, timing.stages
+
+
+def insert_session(parsed_session):
+    """
+    Insert the rows of a session read by `parse_session`
+    :return: dict of the `stages` timings of the session - parsing and inserts
+    """
+    data_file, session_key, parsed_stages, parse_stages = parsed_session
+    timing = SessionTiming()
+    with QueryCounter(experiment.Session.connection) as query_counter:
+        for stage, chunks in parsed_stages:
+            with timing.stage(stage) as stage_timing:
+                stage_timing['tables'] = insert_stage(session_key, stage, chunks, data_file)
+    print(f'-- Inserted {data_file} - database round-trips: {query_counter.count} --')
+    return dict(stages=parse_stages + timing.stages)
+
+
+def match_session(data_file, profile):
+    """
+    Find the Session of this data file
+    :return: session_key, list of the ingestion stages not yet completed for this session
+    """
+    fname = data_file.stem
+    subject_id = int(re.search(r'ANM\d+', fname).group().replace('ANM', ''))
+    session_date = parse_date(re.search(r'_\d+', fname).group().replace('_', ''))
+
+    sessions = (experiment.Session & (experiment.ProjectSession & {'project_name': profile.project_name})
+                & {'subject_id': subject_id, 'session_date': session_date})
+    if len(sessions) < 2:
+        session_key = sessions.fetch1('KEY')
+    else:
+        if fname[-1] in profile.session_suffixes:
+            sess_num = sessions.fetch('session', order_by='session')
+            session_letter_mapper = {letter: s_no for letter, s_no in zip(profile.session_suffixes, sess_num)}
+            session_key = (sessions & {'session': session_letter_mapper[fname[-1]]}).fetch1('KEY')
+        else:
+            raise Exception(f'Multiple sessions found for {fname}')
+
+    print(f'\tMatched: {session_key}')
+
+    stages = incomplete_stages(session_key)
+    if not stages:
+        print('Data ingested, skipping over...')
+    return session_key, stages
+
+
+def incomplete_stages(session_key):
+    """
+    The ingestion stages not yet completed for this session, in ingestion order
+    Sessions with TrialSpikes but no status (i.e. ingested before the stage bookkeeping) are considered complete
+    """
+    completed = (status.SessionIngestion & session_key).fetch('ingestion_stage')
+    if not len(completed) and ephys.TrialSpikes & session_key:
+        return []
+    return [stage for stage in status.IngestionStage.fetch('ingestion_stage', order_by='stage_order')
+            if stage not in completed]
+
+
+def insert_stage(session_key, stage, chunks, data_file):
+    """
+    Insert the (table, rows) `chunks` of one ingestion stage in one transaction, together with its
+    SessionIngestion entry - so that an interrupted ingestion resumes at the first incomplete stage
+    Rows are streamed through one InsertBuffer per table (a BulkInsertBuffer for ColumnarRows), flushed in the
+    background while the next rows are produced - the buffers of the tables produced first (parents) are flushed
+    ahead of the later ones
+    :return: dict of {table name: flush statistics of its InsertBuffer}
+    """
+    print(f'---- Ingesting {stage} data ----')
+    buffers = {}
+    with experiment.SessionTrial.connection.transaction:
+        with ExitStack() as stack:  # flush all buffers on exit - or discard them on error
+            for table, rows in chunks:
+                if table not in buffers:
+                    if isinstance(rows, ColumnarRows):
+                        buffer = BulkInsertBuffer(table, background=True, upstream=buffers.values(),
+                                                  skip_duplicates=insert_kwargs['skip_duplicates'])
+                    else:
+                        buffer = InsertBuffer(table, background=True, upstream=buffers.values(), **insert_kwargs)
+                    buffers[table] = stack.enter_context(buffer)
+                buffers[table].insert(rows)
+        status.SessionIngestion.insert1(dict(session_key, ingestion_stage=stage, data_file=str(data_file)))
+
+    for table, buffer in buffers.items():
+        print(f'\t{table.__name__}: {buffer.stats["rows"]} rows in {buffer.stats["flushes"]} inserts '
+              f'({buffer.stats["bytes"] / 1e6:.1f} MB, {buffer.stats["seconds"]:.1f} s)')
+    return {table.__name__: buffer.stats for table, buffer in buffers.items()}
+
+
+def read_trials(sess_data, profile):
+    """
+    Per-trial arrays of the session: trial, start/stop time, trial-type, early lick, event times and photostim type
+    """
+    trial_time_conversion = sess_data.trial_time_conversion
+    trial_type_mat = sess_data.trial_type_mat
+    trials = dict(trial=sess_data.trial_ids,
+                  start_time=sess_data.trial_start_times,
+                  trial_type_mtx=trial_type_mat[:6, :].T,
+                  early_lick=trial_type_mat[6, :].T,
+                  sample_start=sess_data.trial_property(0) * trial_time_conversion,
+                  delay_start=sess_data.trial_property(1) * trial_time_conversion,
+                  response_start=sess_data.trial_property(2) * trial_time_conversion,
+                  photostim_type=sess_data.trial_property(-1))
+    trials['stop_time'] = profile.trial_stop_time(trials['start_time'], trials['response_start'])
+    return trials
+
+
+# ==================== ROWS OF EACH INGESTION STAGE ====================
+# generators of (table, rows)
+
+def _trial_rows(session_key, sess_data, trials, profile):
+    # rows built from the whole-session arrays - as ColumnarRows, converted to the column types at insert
+    trial_ids = np.asarray(trials['trial']).astype(int)
+
+    yield experiment.SessionTrial, ColumnarRows(keys=session_key, columns=dict(
+        trial=trial_ids,
+        start_time=np.round(trials['start_time'], 4),
+        stop_time=np.round(trials['stop_time'], 4)))
+
+    # decode outcome and instruction: the index of a trial's single trial-type - or "non-performing" (last index)
+    # for trials with none or several trial-types
+    trial_type_mtx = np.asarray(trials['trial_type_mtx']).astype(bool)
+    type_idx = np.where(trial_type_mtx.sum(axis=1) == 1, trial_type_mtx.argmax(axis=1), len(profile.trial_type_str))
+    outcomes, trial_instructions = (np.array(decoded + ('non-performing',)) for decoded in zip(
+        *(profile.trial_type_mapper[trial_type] for trial_type in profile.trial_type_str)))
+
+    yield experiment.BehaviorTrial, ColumnarRows(keys=dict(session_key, **profile.task_protocol), columns=dict(
+        trial=trial_ids,
+        trial_instruction=trial_instructions[type_idx],
+        outcome=outcomes[type_idx],
+        early_lick=np.where(np.asarray(trials['early_lick']).astype(bool), 'early', 'no early')))
+
+    # trial events: (trial, event type) in row-major order, skipping NaN event times
+    event_types = np.array(['sample', 'delay', 'go'])
+    event_times = np.column_stack([trials['sample_start'], trials['delay_start'], trials['response_start']])
+    is_valid = ~np.isnan(event_times)
+
+    yield experiment.TrialEvent, ColumnarRows(keys=session_key, columns=dict(
+        trial=np.repeat(trial_ids, len(event_types)).reshape(event_times.shape)[is_valid],
+        trial_event_id=np.arange(1, is_valid.sum() + 1),
+        trial_event_type=np.tile(event_types, (len(trial_ids), 1))[is_valid],
+        trial_event_time=np.round(event_times[is_valid], 4)))
+
+
+def _photostim_rows(session_key, sess_data, trials, profile):
+    # resolve the photostim keys once - no database queries in the trial loop
+    photostims = (experiment.Photostim * experiment.PhotostimBrainRegion & session_key)
+    if not photostims:
+        return
+    photostim_keys = get_photostim_keys(photostims, profile)
+
+    ts_tvec = sess_data.ts_time
+    aom_input_trace = sess_data.ts_column(1)
+    laser_power = sess_data.ts_column(2)
+    ts_trial_slices = trial_slices(sess_data.ts_trial)
+
+    photostim_trials, photostim_events, photostim_traces = [], [], []
+    unresolved = {}  # {photostim type: trial count} - the types mapping to no Photostim of the session
+    for tr_id, tr_start, delay_start, response_start, photostim_type in zip(*(trials[k] for k in (
+            'trial', 'start_time', 'delay_start', 'response_start', 'photostim_type'))):
+        if photostim_type == 0:
+            continue
+
+        pkey = dict(session_key, trial=tr_id)
+        photostim_trials.append(pkey)
+        if np.isnan(photostim_type):  # unknown photostim type - a photostim trial without event
+            continue
+        photostim_type = int(photostim_type)
+        photostim_key = photostim_keys.get(photostim_type)
+        if not photostim_key:
+            unresolved[photostim_type] = unresolved.get(photostim_type, 0) + 1
+        else:
+            ts_slice = ts_trial_slices.get(tr_id, slice(0, 0))
+            stim_power = laser_power[ts_slice]
+            stim_power = np.where(np.isinf(stim_power), 0, stim_power)  # handle cases where stim power is Inf
+            photostim_events.append(dict(
+                pkey, **photostim_key, photostim_event_id=len(photostim_events)+1,
+                power=stim_power.max() if len(stim_power) > 0 else None,
+                **profile.photostim_event(photostim_type, delay_start, response_start)))
+            photostim_traces.append(dict(pkey, aom_input_trace=aom_input_trace[ts_slice],
+                                         laser_power=laser_power[ts_slice],
+                                         photostim_timestamps=ts_tvec[ts_slice] - tr_start))
+
+    for photostim_type, trial_count in sorted(unresolved.items()):
+        print(f'\tWarning: photostim type {photostim_type} matches no Photostim of {session_key} - '
+              f'no PhotostimEvent/PhotostimTrace for its {trial_count} trial(s)')
+
+    yield experiment.PhotostimTrial, photostim_trials
+    yield experiment.PhotostimEvent, photostim_events
+    yield experiment.PhotostimTrace, photostim_traces
+
+
+def _lick_trace_rows(session_key, sess_data, trials, profile):
+    ts_tvec = sess_data.ts_time
+    lick_trace = sess_data.ts_column(0)
+    ts_trial_slices = trial_slices(sess_data.ts_trial)
+
+    lick_traces = []
+    for tr_id, tr_start in zip(trials['trial'], trials['start_time']):
+        ts_slice = ts_trial_slices.get(tr_id, slice(0, 0))
+        lick_traces.append(dict(session_key, trial=tr_id, lick_trace=lick_trace[ts_slice],
+                                lick_trace_timestamps=ts_tvec[ts_slice] - tr_start))
+
+    yield tracking.LickTrace, lick_traces
+
+
+def _unit_rows(session_key, sess_data, trials, profile):
+    unit_time_conversion = sess_data.unit_time_conversion
+
+    insert_key = (ephys.ProbeInsertion & session_key).fetch1()
+    ap, dv = (ephys.ProbeInsertion.InsertionLocation & session_key).fetch1('ap_location', 'dv_location')
+    e_sites = {e: (y - float(ap), z - float(dv)) for e, y, z in
+               zip(*(ephys.ProbeInsertion.ElectrodeSitePosition & session_key).fetch(
+                   'electrode', 'electrode_posy', 'electrode_posz'))}
+    # trial start and go-cue times, as stored in SessionTrial and TrialEvent - decimal(8, 4)
+    tr_events = {tr: (round(stime, 4), round(gotime, 4)) for tr, stime, gotime in
+                 zip(trials['trial'], trials['start_time'], trials['response_start']) if not np.isnan(gotime)}
+
+    # units are read one at a time - only one unit's spikes and waveforms are held in memory
+    for u_name, u_value in tqdm(sess_data.units()):
+        unit = int(re.search(r'\d+', u_name).group())
+        electrode = np.unique(u_value.channel)[0]
+        spike_times = u_value.eventTimes * unit_time_conversion
+
+        unit_key = dict(insert_key, clustering_method=profile.clustering_method, unit=unit)
+        yield ephys.Unit, [dict(unit_key, electrode_group=0, unit_quality='good',
+                                electrode=electrode, unit_posx=e_sites[electrode][0], unit_posy=e_sites[electrode][1],
+                                spike_times=spike_times, waveform=u_value.waveforms)]
+        yield ephys.UnitCellType, [dict(unit_key, cell_type=(profile.cell_type_mapper[cell_type]
+                                                             if len(cell_type) > 0 else 'N/A'))
+                                   for cell_type in (u_value.cellType
+                                                     if isinstance(u_value.cellType, (list, np.ndarray))
+                                                     else [u_value.cellType])]
+        # get trial's spike times, shift by start-time, then by go-time -> align to go-time
+        trial_spikes = [(tr, tr_spike_times - tr_events[tr][0] - tr_events[tr][1])
+                        for tr, tr_spike_times in split_by_trial(spike_times, u_value.eventTrials).items()
+                        if tr in tr_events]
+        if trial_spikes:
+            tr_ids, tr_spike_times = zip(*trial_spikes)
+            yield ephys.TrialSpikes, ColumnarRows(keys={k: unit_key[k] for k in ephys.Unit.primary_key}, columns=dict(
+                trial=np.array(tr_ids, dtype=int), spike_times=list(tr_spike_times)))
+
+
+stage_rows = {'trial': _trial_rows,
+              'photostim': _photostim_rows,
+              'lick_trace': _lick_trace_rows,
+              'unit': _unit_rows}
+
+
+def main(profile, data_dir='./data/data_structure', workers=1, queue_depth=0,
+         log_file=None, cprofile_session=None, cprofile_dir='.'):
+    """
+    :param workers: number of sessions ingested in parallel, by a pool of worker processes
+    :param queue_depth: if > 0, pipeline the parsing and the inserts - the next sessions are parsed (by a separate
+        process) while the current one is inserted, with at most `queue_depth` parsed sessions held in memory
+    :param log_file: file the per-session stage timings and row/byte counters are written to (JSON lines)
+    :param cprofile_session: dump a cProfile of the session(s) whose file name contains this string to `cprofile_dir`
+    """
+    data_dir = pathlib.Path(data_dir)
+    if not data_dir.exists():
+        raise FileNotFoundError(f'Path not found!! {data_dir.as_posix()}')
+    if workers > 1 and queue_depth > 0:
+        raise ValueError('Use either a pool of workers or a pipelined ingestion, not both')
+    if log_file:
+        log_to_file(log_file)
+    cprofile_kwargs = dict(cprofile_session=cprofile_session, cprofile_dir=cprofile_dir)
+
+    # ================== INGESTION OF DATA ==================
+    if queue_depth > 0:
+        return run_pipelined(partial(parse_session, profile=profile, **cprofile_kwargs), insert_session,
+                             data_dir.glob('*.mat'), queue_depth=queue_depth)
+    return run_sessions(partial(ingest_session, profile=profile, **cprofile_kwargs), data_dir.glob('*.mat'),
+                        workers=workers)
+
+
+def cli(profile, args=None):
+    parser = argparse.ArgumentParser(description=f'Ingest {profile.project_name} session data_structure .mat files')
+    parser.add_argument('data_dir', nargs='?', default='./data/data_structure')
+    parser.add_argument('--workers', type=int, default=1, help='number of sessions ingested in parallel')
+    parser.add_argument('--queue-depth', type=int, default=0,
+                        help='parse the next sessions while inserting the current one, '
+                             'holding at most this many parsed sessions in memory')
+    parser.add_argument('--log-file', default=None,
+                        help='write the per-session stage timings and row/byte counters to this file')
+    parser.add_argument('--cprofile-session', default=None,
+                        help='dump a cProfile of the session(s) whose file name contains this string')
+    parser.add_argument('--cprofile-dir', default='.', help='directory of the cProfile dumps')
+    args = parser.parse_args(args)
+    return main(profile, args.data_dir, workers=args.workers, queue_depth=args.queue_depth,
+                log_file=args.log_file, cprofile_session=args.cprofile_session, cprofile_dir=args.cprofile_dir)
@@ -0,0 +1,448 @@
+'''
+Ingestion engine of the session meta_data .mat files, shared by the two papers
+
+The ingestion is incremental: the md5 hash of each meta_data file is recorded in `status.MetaIngestion`, and only
+new or changed files are processed on later runs. The rows of a changed file are updated in place (new rows are
+inserted, differing secondary attributes are updated) - nothing is deleted, so a metadata fix does not cascade
+down to the ingested data and computed results.
+
+Session numbers are deterministic: a file ingested before keeps its session number, and the new sessions of a
+subject are numbered in chronological order after the subject's existing sessions.
+Sessions ingested before the hash bookkeeping are adopted as they are - only their file hash is recorded - and the
+photostim protocols of an updated session keep their existing numbers (matched by their locations).
+
+The dataset-specific constants are supplied by a `MetaProfile`,
+see `ingest_meta_Li_2015.py` and `ingest_meta_Li_Daie_2016.py`
+'''
+
+import re
+import argparse
+import pathlib
+from datetime import datetime
+from functools import partial
+import multiprocessing as mp
+
+import scipy.io as sio
+from tqdm import tqdm
+import numpy as np
+
+from pipeline import lab, experiment, ephys, virus
+from pipeline import parse_date
+from pipeline.ingest.session_cache import file_hash
+from pipeline.ingest import status
+
+
+class MetaProfile:
+    '''
+    Dataset-specific constants of the metadata ingestion
+    '''
+
+    project_name = None
+
+    # ---- inferred from paper ----
+    hemi = 'left'
+    skull_reference = 'bregma'
+    photostim_devices = {473: 'LaserGem473', 594: 'LaserCoboltMambo100',  596: 'LaserCoboltMambo100'}
+
+    # ---- from lookup ----
+    probe = 'A4x8-5mm-100-200-177'
+    electrode_config_name = 'silicon32'
+
+    def photostim_locations(self, photostim_location, photostim_coordinates):
+        '''
+        Group the photostim coordinates into photostim protocols - one per brain area
+        :return: list of (brain area, coordinates)
+        '''
+        return [(ba, photostim_coordinates[photostim_location == ba]) for ba in sorted(set(photostim_location))]
+
+
+def _as_list(value):
+    return value if isinstance(value, (np.ndarray, list)) else [value]
+
+
+def read_meta(meta_data_file, profile):
+    '''
+    Read one meta_data .mat file into the rows of each table - the session-level rows without the session number,
+    assigned later by `assign_session_numbers`
+    :return: dict of meta_file, meta_hash, subject_key, session_datetime,
+        lookup_rows, subject_rows and session_rows - each a list of (table, rows)
+    '''
+    meta_data = sio.loadmat(meta_data_file, struct_as_record=False, squeeze_me=True)['meta_data']
+
+    # ==================== person ====================
+    person_key = dict(username=meta_data.experimenters,
+                      fullname=meta_data.experimenters)
+
+    # ==================== subject gene modification ====================
+    modified_genes = _as_list(meta_data.animalGeneModification)
+
+    # ==================== subject strain ====================
+    animal_strains = _as_list(meta_data.animalStrain)
+
+    # ==================== subject ====================
+    animal_id = _as_list(meta_data.animalID)[0]
+    animal_source = _as_list(meta_data.animalSource)[0]
+    subject_key = dict(subject_id=int(re.search(r'\d+', animal_id).group()),
+                       sex=meta_data.sex[0].upper() if len(meta_data.sex) != 0 else 'U',
+                       species=meta_data.species,
+                       animal_source=animal_source)
+    try:
+        date_of_birth = parse_date(meta_data.dateOfBirth)
+        subject_key['date_of_birth'] = date_of_birth
+    except:
+        pass
+
+    lookup_rows = [(lab.Person, [person_key]),
+                   (lab.ModifiedGene, [dict(gene_modification=g, gene_modification_description=g)
+                                       for g in modified_genes]),
+                   (lab.AnimalStrain, [dict(animal_strain=strain) for strain in animal_strains]),
+                   (lab.AnimalSource, [dict(animal_source=animal_source)])]
+
+    subject_rows = [(lab.Subject, [subject_key]),
+                    (lab.Subject.GeneModification, [dict(subject_id=subject_key['subject_id'], gene_modification=g)
+                                                    for g in modified_genes]),
+                    (lab.Subject.Strain, [dict(subject_id=subject_key['subject_id'], animal_strain=strain)
+                                          for strain in animal_strains])]
+
+    # ==================== session ====================
+    session_datetime = parse_date(meta_data.dateOfExperiment + ' ' + meta_data.timeOfExperiment)
+    session_key = dict(subject_id=subject_key['subject_id'])
+    session_rows = [(experiment.Session, [dict(session_key, username=person_key['username'],
+                                               session_date=session_datetime.date())]),
+                    (experiment.ProjectSession, [dict(session_key, project_name=profile.project_name)])]
+
+    # ==================== Probe Insertion ====================
+    insertion_key = dict(session_key, insertion_number=1)
+    brain_location_key = dict(brain_area=meta_data.extracellular.recordingLocation,
+                              hemisphere=profile.hemi)
+    insertion_loc_key = dict(skull_reference=profile.skull_reference,
+                             ap_location=meta_data.extracellular.recordingCoordinates[0] * 1000,  # mm to um
+                             ml_location=meta_data.extracellular.recordingCoordinates[1] * 1000,  # mm to um
+                             dv_location=meta_data.extracellular.recordingCoordinates[2] * -1)    # already in um
+
+    session_rows += [
+        (ephys.ProbeInsertion, [dict(insertion_key, probe=profile.probe,
+                                     electrode_config_name=profile.electrode_config_name)]),
+        (ephys.ProbeInsertion.InsertionLocation, [dict(insertion_key, **insertion_loc_key)]),
+        (ephys.ProbeInsertion.RecordableBrainRegion, [dict(insertion_key, **brain_location_key)]),
+        (ephys.ProbeInsertion.ElectrodeSitePosition, [dict(
+            insertion_key, probe=profile.probe, electrode_config_name=profile.electrode_config_name,
+            electrode_group=0, electrode=site_idx + 1,
+            electrode_posx=x*1000, electrode_posy=y*1000, electrode_posz=z*1000)
+            for site_idx, (x, y, z) in enumerate(meta_data.extracellular.siteLocations)])]
+
+    # ==================== Virus ====================
+    if 'virus' in meta_data._fieldnames and isinstance(meta_data.virus, sio.matlab.mio5_params.mat_struct):
+        virus_info = dict(
+            virus_source=meta_data.virus.virusSource,
+            virus=meta_data.virus.virusID,
+            virus_lot_number=meta_data.virus.virusLotNumber if len(meta_data.virus.virusLotNumber) != 0 else '',
+            virus_titer=meta_data.virus.virusTiter.replace('x10', '') if meta_data.virus.virusTiter != 'untitered' else None)
+        lookup_rows.append((virus.Virus, [virus_info]))
+
+        # -- BrainLocation
+        brain_location_key = dict(brain_area=meta_data.virus.infectionLocation,
+                                  hemisphere=profile.hemi)
+        virus_injection = dict(
+            {**virus_info, 'subject_id': subject_key['subject_id'], **brain_location_key},
+            injection_date=parse_date(meta_data.virus.injectionDate))
+
+        subject_rows.append((virus.VirusInjection, [
+            dict(virus_injection,
+                 injection_id=inj_idx + 1,
+                 ap_location=coord[0] * 1000,
+                 ml_location=coord[1] * 1000,
+                 dv_location=coord[2] * 1000 * -1,
+                 injection_volume=vol)
+            for inj_idx, (coord, vol) in enumerate(zip(meta_data.virus.infectionCoordinates,
+                                                       meta_data.virus.injectionVolume))]))
+
+    # ==================== Photostim ====================
+    if 'photostim' in meta_data._fieldnames and isinstance(meta_data.photostim, sio.matlab.mio5_params.mat_struct):
+        photostimLocation = (meta_data.photostim.photostimLocation
+                             if isinstance(meta_data.photostim.photostimLocation, np.ndarray)
+                             else np.array([meta_data.photostim.photostimLocation]))
+        photostimCoordinates = (meta_data.photostim.photostimCoordinates
+                                if isinstance(meta_data.photostim.photostimCoordinates[0], np.ndarray)
+                                else np.array([meta_data.photostim.photostimCoordinates]))
+        photostim_locs = profile.photostim_locations(photostimLocation, photostimCoordinates)
+
+        session_rows += [
+            (experiment.Photostim, [dict(
+                session_key, photo_stim=stim_idx + 1,
+                photostim_device=profile.photostim_devices[meta_data.photostim.photostimWavelength])
+                for stim_idx in range(len(photostim_locs))]),
+            (experiment.Photostim.PhotostimLocation, [dict(
+                session_key, photo_stim=stim_idx + 1,
+                brain_area=loc, skull_reference=profile.skull_reference,
+                ap_location=coord[0] * 1000,
+                ml_location=coord[1] * 1000,
+                dv_location=coord[2] * 1000 * -1)
+                for stim_idx, (loc, coords) in enumerate(photostim_locs) for coord in coords])]
+
+    return dict(meta_file=pathlib.Path(meta_data_file).name, meta_hash=file_hash(meta_data_file),
+                subject_key=subject_key, session_datetime=session_datetime,
+                lookup_rows=lookup_rows, subject_rows=subject_rows, session_rows=session_rows)
+
+
+def assign_session_numbers(metas, project_name):
+    '''
+    Assign the session number of each parsed meta data file (in place, as meta['session']):
+    + a file ingested before keeps its session number
+    + a session ingested before the hash bookkeeping (no MetaIngestion) is matched by subject and date,
+      and flagged as meta['legacy']
+    + the new sessions of a subject are numbered in chronological order, after the subject's existing sessions
+    '''
+    project_sessions = experiment.Session & (experiment.ProjectSession & {'project_name': project_name})
+
+    ingested = {meta_file: (subject_id, session) for meta_file, subject_id, session in zip(
+        *(status.MetaIngestion & project_sessions).fetch('meta_file', 'subject_id', 'session'))}
+
+    unmatched = {}
+    for subject_id, session, session_date in zip(*(project_sessions - status.MetaIngestion).fetch(
+            'subject_id', 'session', 'session_date', order_by='session')):
+        unmatched.setdefault((subject_id, session_date), []).append(session)
+
+    taken = {}
+    for subject_id, session in zip(*experiment.Session.fetch('subject_id', 'session')):
+        taken.setdefault(subject_id, set()).add(session)
+
+    for meta in sorted(metas, key=lambda m: (m['subject_key']['subject_id'], m['session_datetime'], m['meta_file'])):
+        subject_id = meta['subject_key']['subject_id']
+        if ingested.get(meta['meta_file'], (None, None))[0] == subject_id:
+            meta['session'] = ingested[meta['meta_file']][1]
+        elif unmatched.get((subject_id, meta['session_datetime'].date())):
+            meta['session'] = unmatched[(subject_id, meta['session_datetime'].date())].pop(0)
+            meta['legacy'] = True
+        else:
+            meta['session'] = max(taken.get(subject_id, {0})) + 1
+            taken.setdefault(subject_id, set()).add(meta['session'])
+
+
+def _same(current, value):
+    if current is None or value is None:
+        return current is None and value is None
+    if isinstance(value, datetime) and not isinstance(current, datetime):
+        value = value.date()
+    try:
+        return bool(np.isclose(float(current), float(value)))
+    except (TypeError, ValueError):
+        return str(current) == str(value)
+
+
+def upsert(table, rows):
+    '''
+    Insert the rows of `table` not yet in it, update the secondary attributes that differ for the others
+    Rows are never deleted - rows whose primary key changed are added alongside the previous ones
+    :return: number of inserted rows, number of updated rows
+    '''
+    table = table() if isinstance(table, type) else table
+    inserted, updated = 0, 0
+    for row in rows:
+        existing = table & {k: row[k] for k in table.primary_key}
+        if not existing:
+            table.insert1(row, ignore_extra_fields=True)
+            inserted += 1
+            continue
+        current = existing.fetch1()
+        changed = {k: v for k, v in row.items()
+                   if k in table.heading.secondary_attributes and not _same(current[k], v)}
+        if changed:
+            _update_row(table, existing, {k: row[k] for k in table.primary_key}, changed)
+        updated += bool(changed)
+    return inserted, updated
+
+
+def _update_row(table, existing, key, changed):
+    '''
+    Update the `changed` secondary attributes of the row `key` - with `update1` (datajoint >= 0.12.5),
+    or the former private `_update` of the older releases
+    '''
+    if hasattr(table, 'update1'):
+        table.update1({**key, **changed})
+    else:
+        for attr, value in changed.items():
+            existing._update(attr, value)
+
+
+def _photostim_signatures(locations):
+    '''
+    :return: {photo_stim: frozenset of its (brain area, ap, ml, dv) locations} of the PhotostimLocation rows
+    '''
+    signatures = {}
+    for row in locations:
+        signatures.setdefault(row['photo_stim'], set()).add(
+            (row['brain_area'], *(round(float(row[k]), 2) for k in ('ap_location', 'ml_location', 'dv_location'))))
+    return {photo_stim: frozenset(locs) for photo_stim, locs in signatures.items()}
+
+
+def match_photostims(session_key, session_rows):
+    '''
+    Renumber the photostim protocols of `session_rows` after the existing ones of the session: a protocol keeps the
+    `photo_stim` of the existing protocol of the same locations (brain area and coordinates), the others are numbered
+    after the existing ones - existing photostims are never renumbered
+    :return: session_rows, with the Photostim and PhotostimLocation rows renumbered
+    '''
+    existing = {signature: photo_stim for photo_stim, signature in _photostim_signatures(
+        (experiment.Photostim.PhotostimLocation & session_key).fetch(as_dict=True)).items()}
+    new = _photostim_signatures(dict(session_rows).get(experiment.Photostim.PhotostimLocation, []))
+
+    renumbered = {}
+    next_photo_stim = max((experiment.Photostim & session_key).fetch('photo_stim'), default=0) + 1
+    for photo_stim in sorted(new):
+        if new[photo_stim] in existing:
+            renumbered[photo_stim] = existing[new[photo_stim]]
+        else:
+            renumbered[photo_stim], next_photo_stim = next_photo_stim, next_photo_stim + 1
+
+    return [(table, [dict(row, photo_stim=renumbered.get(row['photo_stim'], row['photo_stim'])) for row in rows]
+             if table in (experiment.Photostim, experiment.Photostim.PhotostimLocation) else rows)
+            for table, rows in session_rows]
+
+
+def read_metas(meta_data_files, profile, workers=1):
+    '''
+    Parse the meta data files - in a pool of `workers` processes if `workers > 1` (parsing does not query the database)
+    :return: list of parsed meta data (see `read_meta`), in the order of `meta_data_files`
+    '''
+    meta_data_files = list(meta_data_files)
+    if workers > 1:
+        with mp.get_context('spawn').Pool(workers) as pool:  # as in util.run_sessions - python 3.6
+            return list(tqdm(pool.imap(partial(read_meta, profile=profile), meta_data_files),
+                             total=len(meta_data_files)))
+    metas = []
+    for meta_data_file in tqdm(meta_data_files):
+        print(f'-- Read {meta_data_file} --')
+        metas.append(read_meta(meta_data_file, profile))
+    return metas
+
+
+def _distinct_rows(metas, field):
+    '''
+    Collect the distinct rows of each table over the `field` rows of all `metas`
+    :return: list of (table, rows) - in the order the tables first appear
+    '''
+    table_rows = {}
+    for meta in metas:
+        for table, rows in meta[field]:
+            table_rows.setdefault(table, {}).update(
+                {tuple(sorted(row.items(), key=lambda kv: kv[0])): row for row in rows})
+    return [(table, list(rows.values())) for table, rows in table_rows.items()]
+
+
+def insert_lookups(metas):
+    '''
+    Insert the distinct lookup rows (person, gene modification, strain, animal source, virus) of all `metas` -
+    one insert per table
+    '''
+    for table, rows in _distinct_rows(metas, 'lookup_rows'):
+        table.insert(rows, skip_duplicates=True, ignore_extra_fields=True)
+
+
+def insert_new_subjects(metas):
+    '''
+    Insert the subject rows (subject, gene modifications, strains, virus injections) of the subjects of `metas`
+    not yet ingested - one insert per table
+    :return: set of the inserted subject ids
+    '''
+    subject_ids = {meta['subject_key']['subject_id'] for meta in metas}
+    new_subjects = subject_ids - set((lab.Subject & [dict(subject_id=s) for s in subject_ids]).fetch('subject_id'))
+    new_metas = [meta for meta in metas if meta['subject_key']['subject_id'] in new_subjects]
+    with lab.Subject.connection.transaction:
+        for table, rows in _distinct_rows(new_metas, 'subject_rows'):
+            table.insert(rows, skip_duplicates=True, ignore_extra_fields=True)
+    return new_subjects
+
+
+def ingest_meta_session(meta, update_subject=True):
+    '''
+    Insert - or update in place, if the session exists - the session rows of one parsed meta data file,
+    in one transaction, together with its MetaIngestion entry
+    :param update_subject: also update the subject rows in place (not needed for subjects just inserted)
+    :return: 'new' or 'updated'
+    '''
+    session_key = dict(subject_id=meta['subject_key']['subject_id'], session=meta['session'])
+    is_new = not experiment.Session & session_key
+    print(f'-- {"Insert" if is_new else "Update"} {meta["meta_file"]} - session: {session_key} --')
+
+    session_rows = meta['session_rows'] if is_new else match_photostims(session_key, meta['session_rows'])
+    with experiment.Session.connection.transaction:
+        if update_subject:
+            for table, rows in meta['subject_rows']:
+                upsert(table, rows)
+        for table, rows in session_rows:
+            rows = [dict(row, session=meta['session']) for row in rows]
+            if is_new:
+                table.insert(rows, ignore_extra_fields=True)
+            else:
+                inserted, updated = upsert(table, rows)
+                if inserted or updated:
+                    print(f'\t{table.__name__}: {inserted} inserted, {updated} updated')
+        (status.MetaIngestion & session_key).delete_quick()
+        status.MetaIngestion.insert1(dict(session_key, meta_file=meta['meta_file'], meta_hash=meta['meta_hash']))
+
+    return 'new' if is_new else 'updated'
+
+
+def adopt_meta_session(meta):
+    '''
+    Record the MetaIngestion entry of a session ingested before the hash bookkeeping - its rows are left as they are
+    '''
+    session_key = dict(subject_id=meta['subject_key']['subject_id'], session=meta['session'])
+    print(f'-- Adopt {meta["meta_file"]} - session: {session_key} --')
+    status.MetaIngestion.insert1(dict(session_key, meta_file=meta['meta_file'], meta_hash=meta['meta_hash']))
+    return 'adopted'
+
+
+def ingest_files(profile, meta_data_files, reingest=False, workers=1):
+    '''
+    Two-phase ingestion: all files are parsed first (in parallel, with `workers > 1`), then the distinct lookup and
+    new subject rows are inserted once per table, followed by the rows of each session in one transaction per session
+    Sessions ingested before the hash bookkeeping are adopted: only their MetaIngestion entry is recorded
+    :param reingest: re-process all files, including those unchanged since their last ingestion, and the adopted ones
+    :param workers: number of processes parsing the meta data files
+    :return: list of the session keys inserted or updated
+    '''
+    # ---- phase 1: parse ----
+    metas = read_metas(sorted(meta_data_files), profile, workers=workers)
+    assign_session_numbers(metas, profile.project_name)
+
+    ingested_hashes = {(subject_id, session): meta_hash for subject_id, session, meta_hash
+                       in zip(*status.MetaIngestion.fetch('subject_id', 'session', 'meta_hash'))}
+    pending = [meta for meta in metas if reingest or ingested_hashes.get(
+        (meta['subject_key']['subject_id'], meta['session'])) != meta['meta_hash']]
+
+    # ---- phase 2: insert ----
+    outcomes = [adopt_meta_session(meta) for meta in pending if meta.get('legacy') and not reingest]
+    pending = [meta for meta in pending if reingest or not meta.get('legacy')]
+    insert_lookups(pending)
+    new_subjects = insert_new_subjects(pending)
+    outcomes += [ingest_meta_session(meta, update_subject=meta['subject_key']['subject_id'] not in new_subjects)
+                 for meta in pending]
+    print(f'Meta data files: {outcomes.count("new")} new, {outcomes.count("updated")} updated, '
+          f'{outcomes.count("adopted")} adopted, {len(metas) - len(outcomes)} unchanged')
+
+    return [dict(subject_id=meta['subject_key']['subject_id'], session=meta['session']) for meta in pending]
+
+
+def main(profile, meta_data_dir='./data/meta_data', reingest=False, workers=1):
+    '''
+    Ingest all meta_data files of `meta_data_dir` - see `ingest_files`
+    '''
+    meta_data_dir = pathlib.Path(meta_data_dir)
+    if not meta_data_dir.exists():
+        raise FileNotFoundError(f'Path not found!! {meta_data_dir.as_posix()}')
+
+    # ================== INGESTION OF METADATA ==================
+    ingest_files(profile, meta_data_dir.glob('*.mat'), reingest=reingest, workers=workers)
+
+    experiment.PhotostimBrainRegion.populate(display_progress=True)
+
+
+def cli(profile, args=None):
+    parser = argparse.ArgumentParser(description=f'Ingest {profile.project_name} session meta_data .mat files')
+    parser.add_argument('meta_data_dir', nargs='?', default='./data/meta_data')
+    parser.add_argument('--reingest', action='store_true', help='re-process the unchanged files too')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes parsing the meta data files')
+    args = parser.parse_args(args)
+    return main(profile, args.meta_data_dir, reingest=args.reingest, workers=args.workers)
@@ -1,15 +1,147 @@
+'''
+Populate the computed tables, in dependency order - each table by a pool of worker processes
+
+The workers of a table share its keys through the DataJoint job reservation table (`reserve_jobs`); the next table
+is populated once all the workers of the previous one have exited, i.e. once its jobs are drained.
+The progress and the time of each key are printed as the keys are computed, with a per-table summary.
+
+    python pipeline/ingest/populate.py --workers 8
+'''
 import os, sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
+import time
+import queue
+import argparse
+import traceback
+import multiprocessing as mp
+from contextlib import contextmanager
+
 from pipeline import psth, experiment
 
 
 settings = {'reserve_jobs': True, 'suppress_errors': True, 'display_progress': False}
 
-experiment.PhotostimBrainRegion.populate(**settings)
+# in dependency order
+tables = [experiment.PhotostimBrainRegion,
+          psth.TrialConditionMembership,
+          psth.UnitPsth,
+          psth.PeriodSelectivity,
+          psth.UnitSelectivity]
+
+
+@contextmanager
+def timed_make(table, report):
+    '''
+    Report the time (and error, if any) of each key computed by `table.make` - as dict(table, key, duration, error)
+    '''
+    has_own_make = 'make' in vars(table)
+    make = table.make
+
+    def timed(self, key):
+        start = time.time()
+        try:
+            make(self, key)
+        except Exception:
+            report(dict(table=table.__name__, key=key, duration=time.time() - start,
+                        error=traceback.format_exc().strip().splitlines()[-1]))
+            raise
+        report(dict(table=table.__name__, key=key, duration=time.time() - start, error=None))
+
+    table.make = timed
+    try:
+        yield
+    finally:
+        if has_own_make:
+            table.make = make
+        else:
+            del table.make
+
+
+def _populate_worker(table_name, restrictions, progress_queue):
+    table = {t.__name__: t for t in tables}[table_name]
+    with timed_make(table, progress_queue.put):
+        table.populate(*restrictions, **settings)
+
+
+class Progress:
+    '''
+    Print the progress of the population of one table, and summarize its per-key timings
+    '''
+    def __init__(self, table_name, key_count):
+        self.table_name = table_name
+        self.key_count = key_count
+        self.durations = []
+        self.errors = []
+
+    def update(self, entry):
+        self.durations.append(entry['duration'])
+        if entry['error']:
+            self.errors.append(entry)
+        print(f'[{self.table_name}] {len(self.durations)}/{self.key_count} - {entry["duration"]:.2f} s - '
+              f'{entry["key"]}' + (f' - FAILED: {entry["error"]}' if entry['error'] else ''))
+
+    def summary(self, wall_time):
+        summary = dict(table=self.table_name, keys=len(self.durations), errors=len(self.errors),
+                       wall_time=wall_time, make_time=sum(self.durations),
+                       mean_key_time=sum(self.durations) / len(self.durations) if self.durations else None,
+                       max_key_time=max(self.durations, default=None))
+        print(f'[{self.table_name}] {summary["keys"]} keys ({summary["errors"]} failed) in {wall_time:.1f} s - '
+              f'{summary["make_time"]:.1f} s computing'
+              + (f', {summary["mean_key_time"]:.2f} s/key (max {summary["max_key_time"]:.2f} s)'
+                 if self.durations else ''))
+        return summary
+
+
+def populate_table(table, restrictions=(), workers=1):
+    '''
+    Populate `table` (restricted to `restrictions`) with `workers` worker processes - in this process if `workers` is 1
+    :return: summary of the per-key timings
+    '''
+    todo = table.key_source
+    for restriction in restrictions:
+        todo = todo & restriction
+    progress = Progress(table.__name__, len(todo - table))
+    print(f'==================== {table.__name__}: {progress.key_count} keys - {workers} workers ====================')
+
+    start = time.time()
+    if workers > 1:
+        ctx = mp.get_context('spawn')  # each worker opens its own database connection
+        progress_queue = ctx.Queue()
+        processes = [ctx.Process(target=_populate_worker, args=(table.__name__, restrictions, progress_queue))
+                     for _ in range(workers)]
+        for process in processes:
+            process.start()
+        while any(process.is_alive() for process in processes):
+            try:
+                progress.update(progress_queue.get(timeout=1))
+            except queue.Empty:
+                pass
+        for process in processes:
+            process.join()
+        while True:  # drain the entries sent by the workers just before they exited
+            try:
+                progress.update(progress_queue.get(timeout=0.1))
+            except queue.Empty:
+                break
+    else:
+        with timed_make(table, progress.update):
+            table.populate(*restrictions, **settings)
+
+    return progress.summary(time.time() - start)
+
 
-psth.UnitPsth.populate(**settings)
+def main(workers=1, restrictions=()):
+    '''
+    Populate all tables, in dependency order
+    :param restrictions: restrict the populated keys - e.g. [session_keys] for a list of sessions
+    :return: list of the per-table summaries
+    '''
+    return [populate_table(table, restrictions, workers=workers) for table in tables]
 
-psth.PeriodSelectivity.populate(**settings)
 
-psth.UnitSelectivity.populate(**settings)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Populate the computed tables, in dependency order')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes per table')
+    args = parser.parse_args()
+    main(workers=args.workers)
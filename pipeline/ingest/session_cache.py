@@ -0,0 +1,188 @@
+'''
+On-disk cache of parsed session .mat files
+
+The normalized session structure (trials, time-series, units) is stored as one uncompressed .npz file per
+session, keyed by the md5 hash of the content of the source .mat file and the cache format version - so
+re-running an ingestion on an unchanged file skips the MATLAB parsing altogether. Members are written (and read
+back) one at a time, e.g. one unit at a time.
+
+The cache is enabled by setting `dj.config['custom']['ingest.cache_dir']`; its size is bounded by
+`dj.config['custom']['ingest.cache_size']` (in GB, default 10), evicting the least recently used sessions first.
+'''
+
+import os
+import pathlib
+import hashlib
+import zipfile
+from types import SimpleNamespace
+
+import numpy as np
+import datajoint as dj
+
+from pipeline.ingest.session_reader import SessionReader, open_session
+
+default_cache_size = 10  # GB
+
+# bumped whenever the cached structure or its reading changes - the entries of other versions are never loaded,
+# and are evicted as the least recently used
+cache_format_version = 2
+
+
+def file_hash(data_file, chunksz=2**24):
+    hashed = hashlib.md5()
+    with open(data_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksz), b''):
+            hashed.update(chunk)
+    return hashed.hexdigest()
+
+
+def load_session(data_file, cache_dir=None):
+    '''
+    Open the session of a data_structure .mat file - from the cache when this file content has been parsed before
+    :return: SessionReader - to be used as a context manager
+    '''
+    cache_dir = cache_dir or dj.config['custom'].get('ingest.cache_dir')
+    if not cache_dir:
+        return open_session(data_file)
+
+    cache_dir = pathlib.Path(cache_dir)
+    cache_file = cache_dir / f'{file_hash(data_file)}.v{cache_format_version}.npz'
+    if cache_file.exists():
+        os.utime(cache_file)  # mark as recently used
+        print(f'\tLoad parsed session from cache: {cache_file}')
+    else:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with open_session(data_file) as sess_data:
+            write_session(sess_data, cache_file)
+        evict(cache_dir, keep=cache_file)
+    return CachedSessionReader(np.load(cache_file, allow_pickle=False))
+
+
+def write_session(sess_data, cache_file):
+    '''
+    Write the normalized session structure of `sess_data` (SessionReader) to `cache_file`
+    Written to a temporary file first, so that concurrent ingestions never read a partial cache file
+    '''
+    tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+    with zipfile.ZipFile(tmp_file, 'w', allow_zip64=True) as zf:
+        def put(name, array):
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+        # ---- trial data ----
+        put('trial_ids', sess_data.trial_ids)
+        put('trial_start_times', sess_data.trial_start_times)
+        put('trial_type_mat', sess_data.trial_type_mat)
+        put('trial_time_conversion', sess_data.trial_time_conversion)
+        put('trial_property_count', sess_data.trial_property_count)
+        for idx in range(sess_data.trial_property_count):
+            put(f'trial_property_{idx}', sess_data.trial_property(idx))
+
+        # ---- time-series data ----
+        put('ts_time', sess_data.ts_time)
+        put('ts_trial', sess_data.ts_trial)
+        put('ts_column_count', sess_data.ts_column_count)
+        for idx in range(sess_data.ts_column_count):
+            put(f'ts_column_{idx}', sess_data.ts_column(idx))
+
+        # ---- units ----
+        put('unit_time_conversion', sess_data.unit_time_conversion)
+        unit_names, unit_channels = [], []
+        for idx, (u_name, u_value) in enumerate(sess_data.units()):
+            unit_names.append(u_name)
+            unit_channels.append(np.unique(u_value.channel)[0])
+            put(f'unit_{idx}_event_times', np.atleast_1d(u_value.eventTimes))
+            put(f'unit_{idx}_event_trials', np.atleast_1d(u_value.eventTrials))
+            put(f'unit_{idx}_waveforms', u_value.waveforms)
+            put(f'unit_{idx}_cell_types', np.array(u_value.cellType
+                                                    if isinstance(u_value.cellType, (list, np.ndarray))
+                                                    else [u_value.cellType], dtype=str))
+        put('unit_names', np.array(unit_names, dtype=str))
+        put('unit_channels', np.array(unit_channels))
+
+    os.replace(tmp_file, cache_file)
+
+
+def evict(cache_dir, keep=None):
+    '''
+    Remove the least recently used cached sessions until the cache fits in `ingest.cache_size`
+    '''
+    max_size = float(dj.config['custom'].get('ingest.cache_size', default_cache_size)) * 1e9
+    cache_files = sorted(pathlib.Path(cache_dir).glob('*.npz'), key=lambda f: f.stat().st_mtime)
+    cache_size = sum(f.stat().st_size for f in cache_files)
+    for cache_file in cache_files:
+        if cache_size <= max_size:
+            break
+        if cache_file == keep:
+            continue
+        try:
+            cache_size -= cache_file.stat().st_size
+            cache_file.unlink()
+        except FileNotFoundError:  # already evicted by a concurrent ingestion
+            continue
+        print(f'\tEvict from cache: {cache_file}')
+
+
+class CachedSessionReader(SessionReader):
+    '''
+    SessionReader of a cached .npz session - members are loaded on access
+    '''
+    def __init__(self, npz):
+        super().__init__(obj=None)
+        self._npz = npz
+
+    def close(self):
+        self._npz.close()
+
+    # ---- trial data ----
+    @property
+    def trial_ids(self):
+        return self._npz['trial_ids']
+
+    @property
+    def trial_time_conversion(self):
+        return self._npz['trial_time_conversion'].item()
+
+    @property
+    def trial_start_times(self):
+        return self._npz['trial_start_times']
+
+    @property
+    def trial_type_mat(self):
+        return self._npz['trial_type_mat']
+
+    @property
+    def trial_property_count(self):
+        return self._npz['trial_property_count'].item()
+
+    def trial_property(self, index):
+        return self._npz[f'trial_property_{range(self.trial_property_count)[index]}']
+
+    # ---- time-series data ----
+    @property
+    def ts_time(self):
+        return self._npz['ts_time']
+
+    @property
+    def ts_trial(self):
+        return self._npz['ts_trial']
+
+    @property
+    def ts_column_count(self):
+        return self._npz['ts_column_count'].item()
+
+    def ts_column(self, index):
+        return self._npz[f'ts_column_{range(self.ts_column_count)[index]}']
+
+    # ---- units ----
+    @property
+    def unit_time_conversion(self):
+        return self._npz['unit_time_conversion'].item()
+
+    def units(self):
+        for idx, (u_name, channel) in enumerate(zip(self._npz['unit_names'], self._npz['unit_channels'])):
+            yield str(u_name), SimpleNamespace(eventTimes=self._npz[f'unit_{idx}_event_times'],
+                                               eventTrials=self._npz[f'unit_{idx}_event_trials'],
+                                               channel=channel,
+                                               waveforms=self._npz[f'unit_{idx}_waveforms'],
+                                               cellType=[str(c) for c in self._npz[f'unit_{idx}_cell_types']])
@@ -0,0 +1,239 @@
+'''
+Readers for the session `obj` structure of the data_structure .mat files
+
+Both MATLAB v5 files (read with scipy) and v7.3 / HDF5 files (read lazily with h5py) are supported,
+exposing the same interface to the ingestion scripts.
+For v7.3 files, the fields are only read when accessed - the units of `eventSeriesHash` and the columns of
+`timeSeriesArrayHash` one at a time - so that the memory footprint is bounded by the largest unit
+rather than by the whole file. Uncompressed, contiguous datasets are memory-mapped.
+'''
+
+import scipy.io as sio
+import numpy as np
+
+from pipeline import time_unit_conversion_factor
+
+_hdf5_signature = b'\x89HDF\r\n\x1a\n'
+
+
+def is_hdf5(data_file):
+    '''
+    MATLAB v7.3 files are HDF5 files with a 512-byte MATLAB header (user block)
+    '''
+    with open(data_file, 'rb') as f:
+        f.seek(512)
+        return f.read(len(_hdf5_signature)) == _hdf5_signature
+
+
+def open_session(data_file):
+    '''
+    Open the session `obj` structure of a data_structure .mat file
+    :return: SessionReader - to be used as a context manager
+    '''
+    if is_hdf5(data_file):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError(f'h5py is required to read MATLAB v7.3 file: {data_file}')
+        h5file = h5py.File(data_file, 'r')
+        return SessionReader(_H5Struct(h5file['obj']), h5file=h5file)
+    else:
+        return SessionReader(sio.loadmat(data_file, struct_as_record=False, squeeze_me=True)['obj'])
+
+
+class SessionReader:
+    '''
+    Access to the trial, time-series and unit data of one session, with all times converted to seconds
+    '''
+    def __init__(self, obj, h5file=None):
+        self._obj = obj
+        self._h5file = h5file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, evalue, etraceback):
+        self.close()
+
+    def close(self):
+        if self._h5file is not None:
+            self._h5file.close()
+            self._h5file = None
+
+    def time_conversion(self, time_unit):
+        # (-1) to take into account Matlab's 1-based indexing
+        return time_unit_conversion_factor[self._obj.timeUnitNames[int(time_unit) - 1]]
+
+    # ---- trial data ----
+    @property
+    def trial_ids(self):
+        return self._obj.trialIds
+
+    @property
+    def trial_time_conversion(self):
+        return self.time_conversion(self._obj.trialTimeUnit)
+
+    @property
+    def trial_start_times(self):
+        return self._obj.trialStartTimes * self.trial_time_conversion
+
+    @property
+    def trial_type_mat(self):
+        return np.asarray(self._obj.trialTypeMat)
+
+    @property
+    def trial_property_count(self):
+        return len(self._obj.trialPropertiesHash.value)
+
+    def trial_property(self, index):
+        return self._obj.trialPropertiesHash.value[index]
+
+    # ---- time-series data ----
+    @property
+    def ts_time(self):
+        ts = self._obj.timeSeriesArrayHash.value
+        return ts.time * self.time_conversion(ts.timeUnit)
+
+    @property
+    def ts_trial(self):
+        return self._obj.timeSeriesArrayHash.value.trial
+
+    @property
+    def ts_column_count(self):
+        ts = self._obj.timeSeriesArrayHash.value
+        if isinstance(ts, _H5Struct):
+            return ts._node('valueMatrix').shape[0]
+        return ts.valueMatrix.shape[1]
+
+    def ts_column(self, index):
+        ts = self._obj.timeSeriesArrayHash.value
+        if isinstance(ts, _H5Struct):
+            # stored transposed - a MATLAB column is an HDF5 row, read on its own
+            return ts._node('valueMatrix')[index, :]
+        return ts.valueMatrix[:, index]
+
+    # ---- units ----
+    @property
+    def unit_time_conversion(self):
+        return self.time_conversion(self._obj.eventSeriesHash.value[0].timeUnit)
+
+    def units(self):
+        '''
+        Iterate over the (unit name, unit structure) of `eventSeriesHash` - read one unit at a time
+        '''
+        units = self._obj.eventSeriesHash
+        return zip(units.keyNames, units.value)
+
+
+# ==================== MATLAB v7.3 ====================
+
+def _matlab_class(node):
+    matlab_class = node.attrs.get('MATLAB_class', b'')
+    return matlab_class.decode() if isinstance(matlab_class, bytes) else matlab_class
+
+
+def _read_dataset(dataset):
+    '''
+    Memory-map uncompressed, contiguous numeric datasets - read all other datasets into memory
+    '''
+    if dataset.chunks is None and dataset.compression is None and dataset.dtype.kind in 'iuf':
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode='r',
+                             offset=offset, shape=dataset.shape)
+    return dataset[()]
+
+
+def _squeeze(value):
+    # MATLAB arrays are stored transposed (column-major) - mimic scipy's `squeeze_me=True`
+    value = np.squeeze(value.T)
+    return value.item() if value.ndim == 0 else value
+
+
+def _h5_value(node):
+    import h5py
+
+    if isinstance(node, h5py.Group):
+        return _H5Struct(node)
+
+    matlab_class = _matlab_class(node)
+    if node.attrs.get('MATLAB_empty', 0):
+        return '' if matlab_class == 'char' else np.array([])
+    if h5py.check_dtype(ref=node.dtype) is not None:
+        cell = _H5Cell(node)
+        if len(cell) and _matlab_class(node.file[cell._refs[0]]) == 'char':
+            return list(cell)  # cell array of strings (e.g. cellType) - read eagerly, as a list of str
+        return cell
+    if matlab_class == 'char':
+        return ''.join(map(chr, np.asarray(node[()]).flatten(order='F')))
+    return _squeeze(_read_dataset(node))
+
+
+def _refs(dataset):
+    return np.asarray(dataset[()]).flatten(order='F')
+
+
+class _H5Struct:
+    '''
+    MATLAB struct (or struct array) stored as an HDF5 group - fields are read on attribute access.
+    The fields of a struct array are datasets of references, one per element.
+    '''
+    def __init__(self, group, index=None):
+        self._group = group
+        self._index = index
+
+    @property
+    def _fieldnames(self):
+        return list(self._group.keys())
+
+    def _node(self, name):
+        return self._group[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            node = self._group[name]
+        except KeyError:
+            raise AttributeError(name)
+        if self._index is not None:
+            return _h5_value(node.file[_refs(node)[self._index]])
+        return _h5_value(node)
+
+    def __len__(self):
+        import h5py
+
+        if self._index is not None:
+            return 1
+        for node in self._group.values():
+            if (isinstance(node, h5py.Dataset) and h5py.check_dtype(ref=node.dtype) is not None
+                    and _matlab_class(node) != 'cell'):
+                return node.size
+        return 1
+
+    def __getitem__(self, index):
+        size = len(self)
+        if size == 1 and index in (0, -1):
+            return self
+        return _H5Struct(self._group, index=range(size)[index])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class _H5Cell:
+    '''
+    MATLAB cell array stored as an HDF5 dataset of references - elements are dereferenced and read one at a time
+    '''
+    def __init__(self, dataset):
+        self._dataset = dataset
+        self._refs = _refs(dataset)
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __getitem__(self, index):
+        return _h5_value(self._dataset.file[self._refs[index]])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
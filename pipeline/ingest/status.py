@@ -0,0 +1,64 @@
+'''
+Schema of the ingestion bookkeeping: which ingestion stages have completed for each session,
+and the hash of the meta data file each session was last ingested from
+'''
+import datajoint as dj
+
+from pipeline import experiment, ephys
+from pipeline import get_schema_name
+
+# shared by all users, as the pipeline schemas - the computed tables depend on it (not an `ingest*` per-user schema)
+schema = dj.schema(get_schema_name('session_ingestion'))
+[experiment, ephys]  # NOQA flake8
+
+
+@schema
+class IngestionStage(dj.Lookup):
+    definition = """
+    ingestion_stage: varchar(16)
+    ---
+    stage_order: tinyint        # stages are ingested in this order
+    stage_description: varchar(255)
+    """
+    contents = [
+        ('trial', 1, 'SessionTrial, BehaviorTrial, TrialEvent'),
+        ('photostim', 2, 'PhotostimTrial, PhotostimEvent, PhotostimTrace'),
+        ('lick_trace', 3, 'LickTrace'),
+        ('unit', 4, 'Unit, UnitCellType, TrialSpikes')
+    ]
+
+
+@schema
+class SessionIngestion(dj.Manual):
+    definition = """
+    # Ingestion stages completed for a session - inserted in the same transaction as the stage's data
+    -> experiment.Session
+    -> IngestionStage
+    ---
+    data_file: varchar(255)     # source data file of this stage
+    ingestion_time=CURRENT_TIMESTAMP: timestamp
+    """
+
+
+@schema
+class MetaIngestion(dj.Manual):
+    definition = """
+    # Meta data file of a session, with the hash of its content at its last ingestion
+    -> experiment.Session
+    ---
+    meta_file: varchar(255)     # file name of the meta_data .mat file
+    meta_hash: char(32)         # md5 hash of the file content
+    ingestion_time=CURRENT_TIMESTAMP: timestamp
+    """
+
+
+def completed_sessions():
+    '''
+    Sessions whose data ingestion completed: all the ingestion stages - or TrialSpikes without any stage, i.e.
+    ingested before the stage bookkeeping (as in `ingest_data.incomplete_stages`)
+    '''
+    completed = experiment.Session
+    for stage, *_ in IngestionStage.contents:
+        completed = completed & (SessionIngestion & {'ingestion_stage': stage})
+    legacy = (experiment.Session & ephys.TrialSpikes) - SessionIngestion
+    return experiment.Session & [completed.proj(), legacy.proj()]
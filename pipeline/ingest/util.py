@@ -0,0 +1,286 @@
+'''
+Helpers shared by the ingestion scripts
+'''
+
+import json
+import time
+import queue
+import logging
+import cProfile
+import traceback
+import multiprocessing as mp
+from functools import partial
+from contextlib import contextmanager
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def split_by_trial(values, trial_ids):
+    '''
+    Group `values` by their corresponding `trial_ids` in a single pass:
+    one stable argsort of the trial ids, then `searchsorted` for each trial's boundaries
+    :return: dict of {trial: values of this trial} - each a view into one sorted copy of `values`
+    '''
+    trial_ids = np.atleast_1d(trial_ids)
+    order = np.argsort(trial_ids, kind='stable')
+    sorted_trials = trial_ids[order]
+    sorted_values = np.atleast_1d(values)[order]
+    trials = np.unique(sorted_trials)
+    starts = np.searchsorted(sorted_trials, trials, side='left')
+    stops = np.searchsorted(sorted_trials, trials, side='right')
+    return {tr: sorted_values[start:stop] for tr, start, stop in zip(trials, starts, stops)}
+
+
+def trial_slices(trial_ids):
+    '''
+    Compute the boundaries of each trial's samples over a session-length trial-id vector in a single pass
+    :return: dict of {trial: index} - `index` is a slice (zero-copy view) when the trial's samples are contiguous,
+     the sorted index array of its samples otherwise
+    '''
+    trial_ids = np.atleast_1d(trial_ids)
+    if len(trial_ids) == 0:
+        return {}
+    run_starts = np.flatnonzero(np.r_[True, trial_ids[1:] != trial_ids[:-1]])
+    run_stops = np.r_[run_starts[1:], len(trial_ids)]
+    run_trials = trial_ids[run_starts]
+    is_valid = ~np.isnan(run_trials) if np.issubdtype(run_trials.dtype, np.floating) else np.full(len(run_trials), True)
+    if len(np.unique(run_trials[is_valid])) == is_valid.sum():
+        return {tr: slice(start, stop) for tr, start, stop
+                in zip(run_trials[is_valid], run_starts[is_valid], run_stops[is_valid])}
+    # some trials are split into several runs of samples - fall back to index arrays
+    order = np.argsort(trial_ids, kind='stable')
+    sorted_trials = trial_ids[order]
+    trials = np.unique(run_trials[is_valid])
+    starts = np.searchsorted(sorted_trials, trials, side='left')
+    stops = np.searchsorted(sorted_trials, trials, side='right')
+    return {tr: order[start:stop] for tr, start, stop in zip(trials, starts, stops)}
+
+
+class QueryCounter:
+    '''
+    Context manager counting the database round-trips (queries) issued through `connection`
+    '''
+    def __init__(self, connection):
+        self._connection = connection
+        self.count = 0
+
+    def __enter__(self):
+        # the instance attribute replaced, if any - e.g. the locking wrapper of pipeline._serialize_queries
+        self._previous = self._connection.__dict__.get('query')
+        query = self._connection.query
+
+        def counted_query(*args, **kwargs):
+            self.count += 1
+            return query(*args, **kwargs)
+
+        # still serialized if `query` is the locking wrapper - no need to wrap it again
+        counted_query._query_lock = getattr(query, '_query_lock', None)
+        self._counted_query = counted_query
+        self._connection.query = counted_query
+        return self
+
+    def __exit__(self, etype, evalue, etraceback):
+        if self._connection.__dict__.get('query') is not self._counted_query:
+            return  # wrapped again meanwhile (e.g. locked) - keep the wrapper, which still calls counted_query
+        if self._previous is None:
+            del self._connection.query
+        else:
+            self._connection.query = self._previous
+
+
+class SessionTiming:
+    '''
+    Wall time of each stage of one session ingestion, with the counters (rows, bytes, insert time) of its tables
+    '''
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        entry = dict(stage=name, duration=None, tables={})
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['duration'] = time.time() - start
+            self.stages.append(entry)
+
+
+@contextmanager
+def cprofiled(dump_file=None):
+    '''
+    Run the enclosed block under cProfile, dumping the stats to `dump_file` - a no-op if `dump_file` is None
+    '''
+    if dump_file is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(str(dump_file))
+        print(f'\tProfile dumped to {dump_file}')
+
+
+def log_to_file(log_file):
+    '''
+    Write the per-session report entries - stage timings and counters - to `log_file`, one JSON object per line
+    '''
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+
+def _log_entry(entry):
+    log.info(json.dumps(entry, default=str))
+
+
+def _timed_ingest(ingest_func, data_file):
+    '''
+    Run `ingest_func(data_file)`, returning a report entry instead of raising
+    so that one bad session does not bring down the whole run
+    `ingest_func` may return a dict with the `stages` timings of the session (see SessionTiming)
+    '''
+    start = time.time()
+    stages = None
+    try:
+        result = ingest_func(data_file)
+        status = 'ingested' if result else 'skipped'
+        stages = result.get('stages') if isinstance(result, dict) else None
+        error = None
+    except Exception:
+        status = 'failed'
+        error = traceback.format_exc()
+    return dict(data_file=str(data_file), status=status, duration=time.time() - start, error=error, stages=stages)
+
+
+def run_sessions(ingest_func, data_files, workers=1):
+    '''
+    Apply `ingest_func` to every file in `data_files` and print a summary report
+
+    With `workers > 1`, the sessions are ingested in a process pool. The workers are started with the
+    "spawn" method, so each one imports the pipeline afresh and opens its own DataJoint connection.
+    `ingest_func` must therefore be a module-level function.
+
+    :return: list of report entries (dict of data_file, status, duration, error)
+    '''
+    data_files = sorted(data_files)
+    report = []
+    if workers > 1:
+        # mp.Pool - ProcessPoolExecutor only takes an mp_context from python 3.7 on
+        with mp.get_context('spawn').Pool(workers) as pool:
+            for entry in pool.imap_unordered(partial(_timed_ingest, ingest_func), data_files):
+                print(f'-- {entry["status"]}: {entry["data_file"]} ({entry["duration"]:.1f} s) --')
+                _log_entry(entry)
+                report.append(entry)
+    else:
+        for data_file in data_files:
+            entry = _timed_ingest(ingest_func, data_file)
+            _log_entry(entry)
+            report.append(entry)
+
+    print_report(report)
+    return report
+
+
+def _produce(parse_func, data_files, parsed_queue):
+    '''
+    Producer process of `run_pipelined` - parse every file in `data_files` into `parsed_queue`,
+    blocking while the queue is full; a None entry marks the end of the files
+    '''
+    for data_file in data_files:
+        start = time.time()
+        try:
+            parsed, error = parse_func(data_file), None
+        except Exception:
+            parsed, error = None, traceback.format_exc()
+        parsed_queue.put((str(data_file), parsed, time.time() - start, error))
+    parsed_queue.put(None)
+
+
+def run_pipelined(parse_func, insert_func, data_files, queue_depth=2):
+    '''
+    Apply `parse_func` then `insert_func` to every file in `data_files` and print a summary report -
+    pipelined, so that the next sessions are parsed while the current one is inserted
+
+    `parse_func(data_file)` runs in a separate producer process (started with the "spawn" method, with its own
+    DataJoint connection) and returns the parsed session, or None if there is nothing to insert.
+    The parsed sessions are passed through a queue bounded to `queue_depth` entries: the producer blocks when
+    the queue is full, bounding the memory held by parsed sessions waiting to be inserted.
+    `insert_func(parsed)` runs in this process. Both must be module-level functions.
+
+    :return: list of report entries (dict of data_file, status, duration, error)
+    '''
+    ctx = mp.get_context('spawn')
+    parsed_queue = ctx.Queue(maxsize=queue_depth)
+    producer = ctx.Process(target=_produce, args=(parse_func, sorted(data_files), parsed_queue), daemon=True)
+    producer.start()
+
+    report = []
+    while True:
+        try:
+            item = parsed_queue.get(timeout=1)
+        except queue.Empty:
+            if not producer.is_alive():
+                raise RuntimeError(f'Parsing process exited unexpectedly (exit code {producer.exitcode})')
+            continue
+        if item is None:
+            break
+
+        data_file, parsed, duration, error = item
+        if error is not None:
+            entry = dict(data_file=data_file, status='failed', duration=duration, error=error, stages=None)
+        elif parsed is None:
+            entry = dict(data_file=data_file, status='skipped', duration=duration, error=None, stages=None)
+        else:
+            entry = _timed_ingest(lambda _: insert_func(parsed) or True, data_file)
+            entry['duration'] += duration
+        print(f'-- {entry["status"]}: {entry["data_file"]} ({entry["duration"]:.1f} s) --')
+        _log_entry(entry)
+        report.append(entry)
+
+    producer.join()
+    print_report(report)
+    return report
+
+
+def print_report(report):
+    print('==================== INGESTION SUMMARY ====================')
+    for entry in sorted(report, key=lambda e: e['data_file']):
+        print(f'{entry["status"]:>9} {entry["duration"]:8.1f} s  {entry["data_file"]}')
+    failed = [entry for entry in report if entry['status'] == 'failed']
+    for entry in failed:
+        print(f'---- FAILED: {entry["data_file"]} ----\n{entry["error"]}')
+    print_stage_summary(report)
+    print(f'Total: {len(report)} sessions - '
+          f'{sum(e["status"] == "ingested" for e in report)} ingested, '
+          f'{sum(e["status"] == "skipped" for e in report)} skipped, '
+          f'{len(failed)} failed - '
+          f'{sum(e["duration"] for e in report):.1f} s of session wall time')
+
+
+def print_stage_summary(report):
+    '''
+    Print the time and counters of each ingestion stage, summed over the sessions of the report
+    '''
+    totals = {}
+    for entry in report:
+        for stage in entry.get('stages') or []:
+            total = totals.setdefault(stage['stage'], dict(sessions=0, duration=0., rows=0, bytes=0, insert_seconds=0.))
+            total['sessions'] += 1
+            total['duration'] += stage['duration']
+            for table_stats in stage['tables'].values():
+                total['rows'] += table_stats['rows']
+                total['bytes'] += table_stats['bytes']
+                total['insert_seconds'] += table_stats['seconds']
+    if not totals:
+        return
+    print('---- per-stage totals ----')
+    for stage, total in totals.items():
+        print(f'{stage:>16}: {total["duration"]:8.1f} s over {total["sessions"]} sessions - '
+              f'{total["rows"]} rows, {total["bytes"] / 1e6:.1f} MB, {total["insert_seconds"]:.1f} s inserting')
@@ -0,0 +1,169 @@
+'''
+Incremental ingestion daemon: watch the meta_data and data_structure directories and ingest the new or changed
+.mat files as they land - metadata first, then data - then populate the computed tables for these sessions
+
+The directories are polled: a file is picked up once its size and modification time have been stable for the
+`debounce` period (so that files still being copied are not read, and a burst of files is processed as one batch).
+The files of a batch are ingested by a pool of `workers` processes. The ingestion itself is incremental (meta data
+by file hash, data by ingestion stage) - files already ingested are skipped at little cost, e.g. on startup.
+
+    python pipeline/ingest/watch.py li2015 ./data/meta_data ./data/data_structure --workers 4
+'''
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import time
+import pathlib
+import argparse
+from functools import partial
+
+from pipeline import experiment
+from pipeline.ingest import status, populate
+from pipeline.ingest import ingest_meta, ingest_data
+from pipeline.ingest import ingest_meta_Li_2015, ingest_meta_Li_Daie_2016, ingest_data_Li_2015, ingest_data_Li_Daie_2016
+from pipeline.ingest.util import run_sessions
+
+profiles = {'li2015': (ingest_meta_Li_2015.profile, ingest_data_Li_2015.profile),
+            'lidaie2016': (ingest_meta_Li_Daie_2016.profile, ingest_data_Li_Daie_2016.profile)}
+
+
+class DirectoryWatcher:
+    '''
+    Poll a directory for .mat files, reporting the new or changed ones once they are stable for `debounce` seconds
+    '''
+    def __init__(self, directory, debounce=30, skip_existing=False):
+        self.directory = pathlib.Path(directory)
+        self.debounce = debounce
+        self._seen = {}                                   # {file: (signature, first seen with this signature)}
+        self._processed = self._scan() if skip_existing else {}   # {file: signature}
+        self._failed = set()
+
+    def _scan(self):
+        signatures = {}
+        for f in self.directory.glob('*.mat'):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:  # removed while scanning
+                continue
+            signatures[f] = (stat.st_size, stat.st_mtime)
+        return signatures
+
+    def poll(self):
+        '''
+        :return: list of the files new or changed since their last poll, and stable for `debounce` seconds
+        '''
+        now = time.time()
+        ready = []
+        for f, signature in self._scan().items():
+            if self._processed.get(f) == signature:
+                continue
+            seen_signature, seen_time = self._seen.get(f, (None, None))
+            if seen_signature != signature:
+                self._seen[f] = (signature, now)
+            elif now - seen_time >= self.debounce:
+                ready.append(f)
+        return sorted(ready)
+
+    def mark_processed(self, files, failed=()):
+        for f in files:
+            self._processed[f] = self._seen.pop(f)[0]
+        self._failed.update(failed)
+
+    def retry_failed(self):
+        '''
+        Report the failed files again at the next polls - e.g. data files whose meta data has just been ingested
+        '''
+        for f in self._failed:
+            self._processed.pop(f, None)
+        self._failed.clear()
+
+
+def populate_sessions(session_keys, workers=1):
+    '''
+    Populate the computed tables of `populate.py`, restricted to `session_keys`
+    '''
+    if not session_keys:
+        return
+    print(f'-- Populate {len(session_keys)} sessions --')
+    populate.main(workers=workers, restrictions=[session_keys])
+
+
+def ingest_batch(meta_profile, data_profile, meta_files, data_files, workers=1):
+    '''
+    Ingest a batch of new or changed files - metadata first, then data - and populate their sessions
+    :return: list of the keys of the sessions ingested, list of the data files that failed
+    '''
+    session_keys, failed = [], []
+    if meta_files:
+        print(f'==================== {len(meta_files)} meta data files ====================')
+        meta_session_keys = ingest_meta.ingest_files(meta_profile, meta_files, workers=workers)
+        session_keys += meta_session_keys
+        # the photostim stage of the data ingestion reads the photostim brain regions of the session
+        if meta_session_keys:
+            experiment.PhotostimBrainRegion.populate(meta_session_keys, display_progress=False)
+
+    if data_files:
+        print(f'==================== {len(data_files)} data files ====================')
+        report = run_sessions(partial(ingest_data.ingest_session, profile=data_profile), data_files, workers=workers)
+        ingested = [dict(data_file=entry['data_file']) for entry in report if entry['status'] == 'ingested']
+        failed = [pathlib.Path(entry['data_file']) for entry in report if entry['status'] == 'failed']
+        if ingested:
+            session_keys += (experiment.Session & (status.SessionIngestion & ingested)).fetch('KEY')
+
+    populate_sessions(session_keys, workers=workers)
+    return session_keys, failed
+
+
+def watch(dataset, meta_data_dir, data_dir, workers=1, poll_interval=10, debounce=30, skip_existing=False,
+          once=False):
+    '''
+    Watch `meta_data_dir` and `data_dir`, ingesting the new or changed files as they land - until interrupted
+    :param skip_existing: ignore the files already in the directories at startup, unless they change
+    :param once: process the files ready at the first poll (after `debounce`), then return
+    '''
+    meta_profile, data_profile = profiles[dataset]
+    meta_watcher = DirectoryWatcher(meta_data_dir, debounce=debounce, skip_existing=skip_existing)
+    data_watcher = DirectoryWatcher(data_dir, debounce=debounce, skip_existing=skip_existing)
+    print(f'Watching {meta_data_dir} and {data_dir} - {dataset}')
+
+    try:
+        while True:
+            meta_files, data_files = meta_watcher.poll(), data_watcher.poll()
+            if meta_files or data_files:
+                try:
+                    _, failed = ingest_batch(meta_profile, data_profile, meta_files, data_files, workers=workers)
+                except Exception as e:
+                    # the files of a failed batch stay pending - retried at the next poll
+                    print(f'!! Ingestion of the batch failed: {e}')
+                    if once:
+                        return
+                    time.sleep(poll_interval)
+                    continue
+                meta_watcher.mark_processed(meta_files)
+                if meta_files:
+                    # data files of earlier batches may have failed for lack of their session's meta data - retry them
+                    data_watcher.retry_failed()
+                data_watcher.mark_processed(data_files, failed=failed)
+                if once:
+                    return
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print('Stopped watching')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch the meta_data and data_structure directories, '
+                                                 'ingesting new or changed files as they land')
+    parser.add_argument('dataset', choices=sorted(profiles))
+    parser.add_argument('meta_data_dir')
+    parser.add_argument('data_dir')
+    parser.add_argument('--workers', type=int, default=1, help='number of files ingested in parallel')
+    parser.add_argument('--poll-interval', type=float, default=10, help='seconds between two scans')
+    parser.add_argument('--debounce', type=float, default=30,
+                        help='seconds a file must be unchanged before it is ingested')
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='ignore the files present at startup, unless they change')
+    parser.add_argument('--once', action='store_true', help='process one batch of files, then exit')
+    args = parser.parse_args()
+    watch(args.dataset, args.meta_data_dir, args.data_dir, workers=args.workers, poll_interval=args.poll_interval,
+          debounce=args.debounce, skip_existing=args.skip_existing, once=args.once)
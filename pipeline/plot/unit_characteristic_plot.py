@@ -154,7 +154,7 @@ def plot_unit_bilateral_photostim_effect(probe_insertion, clustering_method=None
 
     # get photostim duration
     stim_durs = np.unique((experiment.Photostim & experiment.PhotostimEvent
-                           * psth.TrialCondition().get_trials('all_noearlylick_bilateral_alm_stim')
+                           * psth.TrialConditionMembership.get_trials('all_noearlylick_bilateral_alm_stim')
                            & probe_insertion).fetch('duration'))
     stim_dur = _extract_one_stim_dur(stim_durs)
 
@@ -171,8 +171,8 @@ def plot_unit_bilateral_photostim_effect(probe_insertion, clustering_method=None
         x, y = (ephys.Unit & unit).fetch1('unit_posx', 'unit_posy')
 
         # obtain unit psth per trial, for all nostim and bistim trials
-        nostim_trials = ephys.Unit.TrialSpikes & unit & psth.TrialCondition.get_trials(no_stim_cond['trial_condition_name'])
-        bistim_trials = ephys.Unit.TrialSpikes & unit & psth.TrialCondition.get_trials(bi_stim_cond['trial_condition_name'])
+        nostim_trials = ephys.Unit.TrialSpikes & unit & psth.TrialConditionMembership.get_trials(no_stim_cond['trial_condition_name'])
+        bistim_trials = ephys.Unit.TrialSpikes & unit & psth.TrialConditionMembership.get_trials(bi_stim_cond['trial_condition_name'])
 
         nostim_psths, nostim_edge = psth.compute_unit_psth(unit, nostim_trials.fetch('KEY'), per_trial=True)
         bistim_psths, bistim_edge = psth.compute_unit_psth(unit, bistim_trials.fetch('KEY'), per_trial=True)
@@ -238,14 +238,16 @@ def plot_stacked_contra_ipsi_psth(units, axs=None):
     sel_c = (ephys.Unit * psth.UnitSelectivity
              & 'unit_selectivity = "contra-selective"' & units)
 
+    unit_psths = psth.UnitPsth & psth.PsthParamSet.default_key()
+
     # ipsi selective ipsi trials
-    psth_is_it = (psth.UnitPsth * sel_i.proj('unit_posy') & conds_i).fetch(order_by='unit_posy desc')
+    psth_is_it = (unit_psths * sel_i.proj('unit_posy') & conds_i).fetch(order_by='unit_posy desc')
     # ipsi selective contra trials
-    psth_is_ct = (psth.UnitPsth * sel_i.proj('unit_posy') & conds_c).fetch(order_by='unit_posy desc')
+    psth_is_ct = (unit_psths * sel_i.proj('unit_posy') & conds_c).fetch(order_by='unit_posy desc')
     # contra selective contra trials
-    psth_cs_ct = (psth.UnitPsth * sel_c.proj('unit_posy') & conds_c).fetch(order_by='unit_posy desc')
+    psth_cs_ct = (unit_psths * sel_c.proj('unit_posy') & conds_c).fetch(order_by='unit_posy desc')
     # contra selective ipsi trials
-    psth_cs_it = (psth.UnitPsth * sel_c.proj('unit_posy') & conds_i).fetch(order_by='unit_posy desc')
+    psth_cs_it = (unit_psths * sel_c.proj('unit_posy') & conds_i).fetch(order_by='unit_posy desc')
 
     _plot_stacked_psth_diff(psth_cs_ct, psth_cs_it, ax=axs[0],
                             vlines=period_starts, flip=True)
@@ -313,14 +315,16 @@ def plot_selectivity_sorted_stacked_contra_ipsi_psth(units, axs=None):
         sel_c = (ephys.Unit * psth.UnitSelectivity
                  & 'unit_selectivity = "contra-selective"' & units)
 
+        unit_psths = psth.UnitPsth & psth.PsthParamSet.default_key()
+
         # ipsi selective ipsi trials
-        psth_is_it = (psth.UnitPsth * sel_i & conds_i).fetch()
+        psth_is_it = (unit_psths * sel_i & conds_i).fetch()
         # ipsi selective contra trials
-        psth_is_ct = (psth.UnitPsth * sel_i & conds_c).fetch()
+        psth_is_ct = (unit_psths * sel_i & conds_c).fetch()
         # contra selective contra trials
-        psth_cs_ct = (psth.UnitPsth * sel_c & conds_c).fetch()
+        psth_cs_ct = (unit_psths * sel_c & conds_c).fetch()
         # contra selective ipsi trials
-        psth_cs_it = (psth.UnitPsth * sel_c & conds_i).fetch()
+        psth_cs_it = (unit_psths * sel_c & conds_i).fetch()
 
         contra_selective_psth.append(_plot_stacked_psth_diff(psth_cs_ct, psth_cs_it, ax=axs[0], flip=True, plot=False))
         ipsi_selective_psth.append(_plot_stacked_psth_diff(psth_is_it, psth_is_ct, ax=axs[1], plot=False))
@@ -382,22 +386,24 @@ def plot_avg_contra_ipsi_psth(units, axs=None):
     sel_c = (ephys.Unit * psth.UnitSelectivity
              & 'unit_selectivity = "contra-selective"' & units)
 
-    psth_is_it = (((psth.UnitPsth & conds_i)
+    unit_psths = psth.UnitPsth & psth.PsthParamSet.default_key()
+
+    psth_is_it = (((unit_psths & conds_i)
                    * ephys.Unit.proj('unit_posy'))
                   & good_unit.proj() & sel_i.proj()).fetch(
                       'unit_psth', order_by='unit_posy desc')
 
-    psth_is_ct = (((psth.UnitPsth & conds_c)
+    psth_is_ct = (((unit_psths & conds_c)
                    * ephys.Unit.proj('unit_posy'))
                   & good_unit.proj() & sel_i.proj()).fetch(
                       'unit_psth', order_by='unit_posy desc')
 
-    psth_cs_ct = (((psth.UnitPsth & conds_c)
+    psth_cs_ct = (((unit_psths & conds_c)
                    * ephys.Unit.proj('unit_posy'))
                   & good_unit.proj() & sel_c.proj()).fetch(
                       'unit_psth', order_by='unit_posy desc')
 
-    psth_cs_it = (((psth.UnitPsth & conds_i)
+    psth_cs_it = (((unit_psths & conds_i)
                    * ephys.Unit.proj('unit_posy'))
                   & good_unit.proj() & sel_c.proj()).fetch(
                       'unit_psth', order_by='unit_posy desc')
@@ -432,23 +438,25 @@ def plot_psth_photostim_effect(units, condition_name_kw=['bilateral_alm'], axs=N
     psth_n_l = psth.TrialCondition.get_cond_name_from_keywords(['_nostim', '_left'])[0]
     psth_n_r = psth.TrialCondition.get_cond_name_from_keywords(['_nostim', '_right'])[0]
 
-    psth_n_l = (psth.UnitPsth * psth.TrialCondition & units
+    unit_psths = psth.UnitPsth & psth.PsthParamSet.default_key()
+
+    psth_n_l = (unit_psths * psth.TrialCondition & units
                 & {'trial_condition_name': psth_n_l} & 'unit_psth is not NULL').fetch('unit_psth')
-    psth_n_r = (psth.UnitPsth * psth.TrialCondition & units
+    psth_n_r = (unit_psths * psth.TrialCondition & units
                 & {'trial_condition_name': psth_n_r} & 'unit_psth is not NULL').fetch('unit_psth')
 
     psth_s_l = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim_left'])[0]
     psth_s_r = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim_right'])[0]
 
-    psth_s_l = (psth.UnitPsth * psth.TrialCondition & units
+    psth_s_l = (unit_psths * psth.TrialCondition & units
                 & {'trial_condition_name': psth_s_l} & 'unit_psth is not NULL').fetch('unit_psth')
-    psth_s_r = (psth.UnitPsth * psth.TrialCondition & units
+    psth_s_r = (unit_psths * psth.TrialCondition & units
                 & {'trial_condition_name': psth_s_r} & 'unit_psth is not NULL').fetch('unit_psth')
 
     # get photostim duration and stim time (relative to go-cue)
     stim_trial_cond_name = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim'])[0]
     stim_time, stim_dur = _get_photostim_time_and_duration(units,
-                                                           psth.TrialCondition().get_trials(stim_trial_cond_name))
+                                                           psth.TrialConditionMembership.get_trials(stim_trial_cond_name))
 
     if hemi == 'left':
         psth_s_i = psth_s_l
@@ -493,7 +501,7 @@ def plot_selectivity_change_photostim_effect(units, condition_name_kw, recover_t
 
     stim_trial_cond_name = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim'])[0]
     stim_time, stim_dur = _get_photostim_time_and_duration(units,
-                                                           psth.TrialCondition().get_trials(stim_trial_cond_name))
+                                                           psth.TrialConditionMembership.get_trials(stim_trial_cond_name))
 
     ctrl_left_cond_name = 'all_noearlylick_nostim_left'
     ctrl_right_cond_name = 'all_noearlylick_nostim_right'
@@ -506,12 +514,12 @@ def plot_selectivity_change_photostim_effect(units, condition_name_kw, recover_t
     for unit in (units * psth.UnitSelectivity & 'unit_selectivity != "non-selective"').proj('unit_selectivity').fetch(as_dict=True):
         # ---- trial count criteria ----
         # no less than 5 trials for control
-        if (len(psth.TrialCondition.get_trials(ctrl_left_cond_name) & unit) < 5
-                or len(psth.TrialCondition.get_trials(ctrl_right_cond_name) & unit) < 5):
+        if (len(psth.TrialConditionMembership.get_trials(ctrl_left_cond_name) & unit) < 5
+                or len(psth.TrialConditionMembership.get_trials(ctrl_right_cond_name) & unit) < 5):
             continue
         # no less than 2 trials for stimulation
-        if (len(psth.TrialCondition.get_trials(stim_left_cond_name) & unit) < 2
-                or len(psth.TrialCondition.get_trials(stim_right_cond_name) & unit) < 2):
+        if (len(psth.TrialConditionMembership.get_trials(stim_left_cond_name) & unit) < 2
+                or len(psth.TrialConditionMembership.get_trials(stim_right_cond_name) & unit) < 2):
             continue
 
         hemi = _get_units_hemisphere(unit)
@@ -3,7 +3,7 @@ import numpy as np
 
 import matplotlib.pyplot as plt
 
-from pipeline.psth import TrialCondition
+from pipeline.psth import TrialCondition, TrialConditionMembership
 from pipeline.psth import UnitPsth
 from pipeline import ephys, experiment
 from pipeline.plot.util import _get_photostim_time_and_duration, _get_trial_event_times, _get_units_hemisphere
@@ -84,7 +84,7 @@ def plot_unit_psth(unit_key, condition_name_kw=['good_noearlylick_', '_hit'], ax
     # photostim shaded bar (if applicable)
     try:
         stim_trial_cond_name = TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim'])[0]
-        stim_bar = _get_photostim_time_and_duration(unit_key, TrialCondition().get_trials(stim_trial_cond_name))
+        stim_bar = _get_photostim_time_and_duration(unit_key, TrialConditionMembership.get_trials(stim_trial_cond_name))
     except:
         stim_bar = None
 
@@ -143,7 +143,7 @@ def _get_trial_event_times(events, units, trial_cond_name):
     """
     events = list(events) + ['go']
 
-    event_types, event_times = (psth.TrialCondition().get_trials(trial_cond_name)
+    event_types, event_times = (psth.TrialConditionMembership.get_trials(trial_cond_name)
                                 * (experiment.TrialEvent & [{'trial_event_type': eve} for eve in events])
                                 & units).fetch('trial_event_type', 'trial_event_time')
     period_starts = [np.nanmedian((event_times[event_types == event_type] - event_times[event_types == 'go']).astype(float))
@@ -1,9 +1,9 @@
 import logging
 import math
+import decimal
 import hashlib
 
 from functools import partial
-from inspect import getmembers
 from itertools import repeat
 
 import numpy as np
@@ -15,9 +15,11 @@ from . import lab
 from . import experiment
 from . import ephys
 from . import smooth_psth
+from .psth_engine import RaggedSpikes, psth_bin_edges, bin_spikes, spike_histograms, compute_psths
 [lab, experiment, ephys]  # NOQA
 
 from . import get_schema_name
+from .ingest import status
 from .plot.util import _get_units_hemisphere
 
 schema = dj.schema(get_schema_name('psth'))
@@ -136,11 +138,49 @@ class TrialCondition(dj.Lookup):
                            **d['trial_condition_arg']})}
                 for d in contents_data)
 
+    # process-level caches of the condition definitions - see invalidate_cache()
+    _definitions = None     # {trial_condition_name: (trial_condition_func, trial_condition_arg)}
+    _callables = {}         # {trial_condition_name: partial(trial_condition_func, **trial_condition_arg)}
+    _keyword_index = {}     # {keyword: set of the condition names containing it}
+    _keyword_matches = {}   # {tuple of keywords: sorted matching condition names}
+
+    @classmethod
+    def invalidate_cache(cls):
+        """
+        Clear the cached condition definitions - e.g. after conditions are inserted from another process
+        """
+        cls._definitions = None
+        cls._callables = {}
+        cls._keyword_index = {}
+        cls._keyword_matches = {}
+
     @classmethod
     def insert_trial_conditions(cls, contents_data):
         cls.insert(({**d, 'trial_condition_hash': key_hash({'trial_condition_func': d['trial_condition_func'],
                                                             **d['trial_condition_arg']})}
                     for d in contents_data), skip_duplicates=True)
+        cls.invalidate_cache()
+
+    @classmethod
+    def get_definitions(cls):
+        """
+        :return: {trial_condition_name: (trial_condition_func, trial_condition_arg)} - fetched once per process
+        """
+        if cls._definitions is None:
+            names, funcs, args = cls.fetch('trial_condition_name', 'trial_condition_func', 'trial_condition_arg')
+            cls._definitions = dict(zip(names, zip(funcs, args)))
+        return cls._definitions
+
+    @classmethod
+    def get_definition(cls, trial_condition_name):
+        """
+        :return: (trial_condition_func, trial_condition_arg) of this condition
+        """
+        if trial_condition_name not in cls.get_definitions():
+            cls.invalidate_cache()  # inserted since the cache was filled?
+        if trial_condition_name not in cls.get_definitions():
+            raise dj.DataJointError('Unknown trial condition: {}'.format(trial_condition_name))
+        return cls.get_definitions()[trial_condition_name]
 
     @classmethod
     def get_trials(cls, trial_condition_name):
@@ -148,27 +188,39 @@ class TrialCondition(dj.Lookup):
 
     @classmethod
     def get_cond_name_from_keywords(cls, keywords):
-        matched_cond_names = []
-        for cond_name in cls.fetch('trial_condition_name'):
-            match = True
-            tmp_cond = cond_name
-            for k in keywords:
-                if k in tmp_cond:
-                    tmp_cond = tmp_cond.replace(k, '')
-                else:
-                    match = False
-                    break
-            if match:
-                matched_cond_names.append(cond_name)
-        return sorted(matched_cond_names)
+        keywords = tuple(keywords)
+        if keywords not in cls._keyword_matches:
+            names = set(cls.get_definitions())
+            for k in keywords:  # candidates: the names containing all keywords
+                if k not in cls._keyword_index:
+                    cls._keyword_index[k] = {name for name in cls.get_definitions() if k in name}
+                names &= cls._keyword_index[k]
+
+            matched_cond_names = []
+            for cond_name in names:
+                # each keyword must match in what remains of the name once the previous ones are removed
+                match = True
+                tmp_cond = cond_name
+                for k in keywords:
+                    if k in tmp_cond:
+                        tmp_cond = tmp_cond.replace(k, '')
+                    else:
+                        match = False
+                        break
+                if match:
+                    matched_cond_names.append(cond_name)
+            cls._keyword_matches[keywords] = sorted(matched_cond_names)
+        return list(cls._keyword_matches[keywords])
 
     @classmethod
     def get_func(cls, key):
-        self = cls()
-        func, args = (self & key).fetch1(
-            'trial_condition_func', 'trial_condition_arg')
-
-        return partial(dict(getmembers(cls))[func], **args)
+        if not isinstance(key, dict) or set(key) != {'trial_condition_name'}:  # other restrictions: resolve the name
+            key = (cls & key).fetch1('KEY')
+        name = key['trial_condition_name']
+        if name not in cls._callables:
+            func, args = cls.get_definition(name)
+            cls._callables[name] = partial(getattr(cls, func), **args)
+        return cls._callables[name]
 
     @classmethod
     def _get_trials_exclude_stim(cls, **kwargs):
@@ -223,50 +275,295 @@ class TrialCondition(dj.Lookup):
                  - [{k: v} for k, v in _stim_key.items()]).proj())
 
 
+def _normalized(value):
+    # values compared as MySQL does: strings case-insensitively, numbers (e.g. decimal durations) by value
+    if isinstance(value, str):
+        return value.lower()
+    if isinstance(value, (int, float, np.number, decimal.Decimal)) and not isinstance(value, bool):
+        return round(float(value), 6)
+    return value
+
+
+def _factorize(column):
+    """
+    Encode `column` as integer codes - :return: (codes, {normalized value: code}), NULLs coded -1 (never equal)
+    """
+    lookup = {}
+    codes = np.array([-1 if v is None else lookup.setdefault(_normalized(v), len(lookup)) for v in column], dtype=int)
+    return codes, lookup
+
+
+class SessionTrialMasks:
+    """
+    In-memory evaluation of TrialCondition arguments over the trials of one session.
+
+    The BehaviorTrial and photostim attributes of the session are fetched once, as integer-coded numpy columns;
+    any (trial_condition_func, trial_condition_arg) - stored in TrialCondition or not - is then evaluated
+    into a boolean mask over `trials`, with the semantics of TrialCondition._get_trials_exclude_stim/include_stim:
+    inclusion (attr) is AND - exclusion (_attr) is OR.
+
+        masks = SessionTrialMasks(session_key)
+        masks.get_trials('good_noearlylick_left_hit')
+        masks.evaluate('_get_trials_exclude_stim', outcome='hit', trial_instruction='left', _early_lick='early')
+
+    `cross_check()` compares the masks against the SQL expansion of TrialCondition.get_trials()
+    """
+
+    stim_funcs = {'_get_trials_exclude_stim': False, '_get_trials_include_stim': True}
+
+    def __init__(self, session_key):
+        self.session_key = (experiment.Session & session_key).fetch1('KEY')
+
+        behav_attrs = experiment.BehaviorTrial.heading.names
+        behav = (experiment.BehaviorTrial & self.session_key).fetch(*behav_attrs, order_by='trial')
+        behav = dict(zip(behav_attrs, behav))
+        self.trials = behav['trial']
+        self._behav = {attr: _factorize(column) for attr, column in behav.items()}
+
+        stim_q = experiment.PhotostimEvent * experiment.PhotostimBrainRegion * experiment.Photostim
+        stim_attrs = [attr for attr in stim_q.heading.names if attr not in experiment.Session.heading.names
+                      and not stim_q.heading.attributes[attr].is_blob]
+        stim = dict(zip(stim_attrs, (stim_q & self.session_key).fetch(*stim_attrs)))
+        # one row per photostim event - of the trials in BehaviorTrial
+        in_behav = np.isin(stim['trial'], self.trials)
+        self._stim_trial_idx = np.searchsorted(self.trials, stim['trial'][in_behav])
+        self._stim = {attr: _factorize(column[in_behav]) for attr, column in stim.items()}
+
+    @staticmethod
+    def _match(columns, attr, value):
+        codes, lookup = columns[attr]
+        code = lookup.get(_normalized(value))
+        return codes == code if code is not None else np.zeros(len(codes), dtype=bool)
+
+    def _restrict(self, columns, restr, _restr, row_count):
+        mask = np.ones(row_count, dtype=bool)
+        for attr, value in restr.items():
+            mask &= self._match(columns, attr, value)
+        for attr, value in _restr.items():
+            mask &= ~self._match(columns, attr, value)
+        return mask
+
+    def evaluate(self, trial_condition_func, **trial_condition_arg):
+        """
+        :return: boolean mask over `trials` of the trials of this trial condition
+        """
+        if trial_condition_func not in self.stim_funcs:
+            raise ValueError('Unsupported trial condition function: {}'.format(trial_condition_func))
+
+        restr, _restr = {}, {}
+        for k, v in trial_condition_arg.items():
+            if k.startswith('_'):
+                _restr[k[1:]] = v
+            else:
+                restr[k] = v
+
+        # attributes of neither BehaviorTrial nor the photostim tables are ignored, as in the SQL restrictions
+        behav_mask = self._restrict(self._behav,
+                                    {k: v for k, v in restr.items() if k in self._behav},
+                                    {k: v for k, v in _restr.items() if k in self._behav}, len(self.trials))
+        stim_mask = self._restrict(self._stim,
+                                   {k: v for k, v in restr.items() if k in self._stim},
+                                   {k: v for k, v in _restr.items() if k in self._stim}, len(self._stim_trial_idx))
+        is_stim = np.zeros(len(self.trials), dtype=bool)
+        is_stim[self._stim_trial_idx[stim_mask]] = True
+
+        return behav_mask & (is_stim if self.stim_funcs[trial_condition_func] else ~is_stim)
+
+    def get_mask(self, trial_condition_name):
+        func, args = TrialCondition.get_definition(trial_condition_name)
+        return self.evaluate(func, **args)
+
+    def get_trials(self, trial_condition_name):
+        """
+        :return: trial numbers of this trial condition - as TrialCondition.get_trials() for this session
+        """
+        return self.trials[self.get_mask(trial_condition_name)]
+
+    def cross_check(self, trial_condition_names=None):
+        """
+        Compare the masks with the SQL expansion of the trial conditions (all by default)
+        :return: {trial_condition_name: (trials of the mask only, trials of the SQL expansion only)} of the mismatches
+        """
+        if trial_condition_names is None:
+            trial_condition_names = TrialCondition.get_definitions()
+        mismatches = {}
+        for name in trial_condition_names:
+            mask_trials = set(self.get_trials(name))
+            sql_trials = set((TrialCondition.get_trials(name) & self.session_key).fetch('trial'))
+            if mask_trials != sql_trials:
+                mismatches[name] = (sorted(mask_trials - sql_trials), sorted(sql_trials - mask_trials))
+        return mismatches
+
+
 @schema
-class UnitPsth(dj.Computed):
+class TrialConditionMembership(dj.Computed):
+    """
+    The trials of each TrialCondition, per session - TrialCondition.get_trials() materialized,
+    so that downstream code restricts by an indexed join instead of re-expanding the condition
+
+    Populated once the session's data ingestion completed - the first key of a session evaluates all its trial
+    conditions not yet populated, in one pass; the conditions inserted later are populated as new keys.
+    """
+
     definition = """
     -> TrialCondition
-    -> ephys.Unit
-    ---
-    unit_psth=NULL: longblob
+    -> experiment.Session
     """
-    psth_params = {'xmin': -3, 'xmax': 3, 'binsize': 0.04}
+
+    class Trial(dj.Part):
+        definition = """
+        -> master
+        -> experiment.BehaviorTrial
+        """
+
+    key_source = TrialCondition.proj() * (status.completed_sessions() & experiment.BehaviorTrial).proj()
 
     def make(self, key):
-        log.info('UnitPsth.make(): key: {}'.format(key))
+        """
+        Evaluate the trial conditions of the session of `key` not yet populated, with SessionTrialMasks -
+        `populate` then skips the session's other keys
+        """
+        log.debug('TrialConditionMembership.make(): key: {}'.format(key))
 
-        # expand TrialCondition to trials,
-        trials = TrialCondition.get_trials(key['trial_condition_name'])
+        masks = SessionTrialMasks(key)
+        todo = (TrialCondition.proj() * experiment.Session.proj() & masks.session_key) - self.proj()
+        conditions = todo.fetch('KEY')
 
-        # fetch related spike times
-        q = (ephys.TrialSpikes & key & trials.proj())
-        spikes = q.fetch('spike_times')
+        # skip_duplicates: the same conditions may be evaluated concurrently by another worker's key of the session
+        self.insert(conditions, skip_duplicates=True)
+        self.Trial.insert(({**cond, 'trial': trial} for cond in conditions
+                           for trial in masks.get_trials(cond['trial_condition_name'])), skip_duplicates=True)
 
-        if len(spikes) == 0:
-            log.warning('no spikes found for key {} - null psth'.format(key))
-            self.insert1(key)
-            return
+    @classmethod
+    def get_trials(cls, trial_condition_name):
+        """
+        Same as TrialCondition.get_trials() - for the sessions where the membership is populated
+        """
+        return experiment.BehaviorTrial & (cls.Trial & {'trial_condition_name': trial_condition_name})
 
-        # compute psth & store.
-        # XXX: xmin, xmax+bins (149 here vs 150 in matlab)..
-        #   See also [:1] slice in plots..
-        unit_psth = self.compute_psth(spikes)
 
-        self.insert1({**key, 'unit_psth': unit_psth})
+@schema
+class PsthParamSet(dj.Lookup):
+    """
+    PSTH parameters - window and bin size - keyed by their hash, so that several resolutions coexist in UnitPsth
+    """
+
+    definition = """
+    psth_param_set_hash:    varchar(32)     # hash of the psth parameters
+    ---
+    xmin:                   double          # (s) start of the psth window, relative to the go cue
+    xmax:                   double          # (s) end of the psth window - bin edges np.arange(xmin, xmax, binsize)
+    binsize:                double          # (s)
+    """
+
+    default_params = {'xmin': -3, 'xmax': 3, 'binsize': 0.04}
 
     @staticmethod
-    def compute_psth(session_unit_spikes):
-        spikes = np.concatenate(session_unit_spikes)
+    def params_key(params):
+        # hashed as floats - e.g. xmin -3 and -3.0 are the same parameter set
+        return {'psth_param_set_hash': key_hash({k: float(v) for k, v in params.items()})}
+
+    @property
+    def contents(self):
+        return [{**self.default_params, **self.params_key(self.default_params)}]
+
+    @classmethod
+    def insert_new_params(cls, xmin, xmax, binsize):
+        params = {'xmin': xmin, 'xmax': xmax, 'binsize': binsize}
+        param_set_key = cls.params_key(params)
+        cls.insert1({**params, **param_set_key}, skip_duplicates=True)
+        return param_set_key
+
+    @classmethod
+    def default_key(cls):
+        return cls.params_key(cls.default_params)
+
+
+@schema
+class UnitPsth(dj.Computed):
+    definition = """
+    -> TrialCondition
+    -> ephys.Unit
+    -> PsthParamSet
+    ---
+    unit_psth=NULL: longblob
+    """
+    psth_params = PsthParamSet.default_params  # default parameters of the psth computed on the fly
 
-        xmin, xmax, bins = UnitPsth.psth_params.values()
-        psth = list(np.histogram(spikes, bins=np.arange(xmin, xmax, bins)))
-        psth[0] = psth[0] / len(session_unit_spikes) / bins
+    # keyed per (trial condition, session, psth parameter set): the conditions and parameter sets inserted later are
+    # populated as new keys - the first key of a session computes all the session's missing psths in one pass
+    key_source = TrialConditionMembership.proj() * PsthParamSet.proj() & ephys.Unit
 
-        return np.array(psth)
+    def make(self, key):
+        """
+        Compute the psth of all the (trial condition, unit, psth parameter set) of the session of `key` not yet
+        populated - `populate` then skips the session's other keys.
+        The trials of all conditions are fetched from TrialConditionMembership, and the session's TrialSpikes,
+        in one query each - binned once per parameter set.
+        """
+        log.info('UnitPsth.make(): key: {}'.format(key))
+
+        session_key = (experiment.Session & key).fetch1('KEY')
+        todo = ((TrialConditionMembership.proj() * ephys.Unit.proj() * PsthParamSet.proj() & session_key)
+                - self.proj()).fetch('KEY')
+
+        # fetch the session's spike times - one row per unit x trial
+        unit_attrs = [k for k in ephys.Unit.primary_key if k not in session_key]
+        *unit_values, trials, spikes = (ephys.TrialSpikes & session_key).fetch(*unit_attrs, 'trial', 'spike_times')
+        unit_ids = list(zip(*unit_values))
+        unit_index = {u: idx for idx, u in enumerate(sorted(set(unit_ids)))}
+        row_units = np.array([unit_index[u] for u in unit_ids], dtype=int)
+
+        spikes = RaggedSpikes.from_rows(spikes)
+        cond_names, cond_trials = (TrialConditionMembership.Trial & session_key).fetch('trial_condition_name', 'trial')
+
+        cond_rows = {}  # {trial_condition_name: (is_cond_row, trial count per unit)}
+        for cond_name in set(k['trial_condition_name'] for k in todo):
+            is_cond_row = np.isin(trials, cond_trials[cond_names == cond_name])
+            cond_rows[cond_name] = (is_cond_row, np.bincount(row_units[is_cond_row], minlength=len(unit_index)))
+
+        unit_psths = {}
+        for param_set_hash in set(k['psth_param_set_hash'] for k in todo):
+            # XXX: xmin, xmax+bins (149 here vs 150 in matlab)..
+            #   See also [:1] slice in plots..
+            xmin, xmax, binsize = (PsthParamSet & {'psth_param_set_hash': param_set_hash}).fetch1(
+                'xmin', 'xmax', 'binsize')
+            edges = psth_bin_edges(xmin, xmax, binsize)
+            nbins = len(edges) - 1
+            spike_rows, spike_bins = bin_spikes(spikes, edges)
+
+            for cond_name, (is_cond_row, trial_counts) in cond_rows.items():
+                is_cond_spike = is_cond_row[spike_rows]
+                counts = spike_histograms(row_units[spike_rows[is_cond_spike]], spike_bins[is_cond_spike],
+                                          nbins, len(unit_index))
+                unit_psths[cond_name, param_set_hash] = (counts / binsize, trial_counts, edges)
+
+        entries = []
+        for k in todo:
+            rates, trial_counts, edges = unit_psths[k['trial_condition_name'], k['psth_param_set_hash']]
+            u = unit_index.get(tuple(k[a] for a in unit_attrs))
+            if u is None or trial_counts[u] == 0:
+                log.warning('no spikes found for key {} - null psth'.format(k))
+                entries.append(k)
+                continue
+            unit_psth = np.empty(2, dtype=object)  # as in compute_psth
+            unit_psth[0], unit_psth[1] = rates[u] / trial_counts[u], edges
+            entries.append({**k, 'unit_psth': unit_psth})
+
+        # skip_duplicates: the same psths may be computed concurrently by another worker's key of the session
+        self.insert(entries, skip_duplicates=True)
+
+    @staticmethod
+    def compute_psth(session_unit_spikes, psth_params=None):
+        xmin, xmax, bins = (psth_params or UnitPsth.psth_params).values()
+        psth, edges = compute_psths(RaggedSpikes.from_rows(session_unit_spikes), xmin, xmax, bins)
+
+        unit_psth = np.empty(2, dtype=object)  # np.array([psth, edges]) - of different lengths
+        unit_psth[0], unit_psth[1] = psth, edges
+        return unit_psth
 
     @classmethod
-    def get_plotting_data(cls, unit_key, condition_key):
+    def get_plotting_data(cls, unit_key, condition_key, psth_param_set_key=None):
         """
         Retrieve / build data needed for a Unit PSTH Plot based on the given
         unit condition and included / excluded condition (sub-)variables.
@@ -277,15 +574,17 @@ class UnitPsth(dj.Computed):
              'psth': UnitPsth.unit_psth - smoothed,
              'raster': Spike * Trial raster [np.array, np.array]
           }
+        of the psth of `psth_param_set_key` - the default PsthParamSet if None
         """
         # from sys import exit as sys_exit  # NOQA
         # from code import interact
         # from collections import ChainMap
         # interact('unitpsth make', local=dict(ChainMap(locals(), globals())))
 
-        trials = TrialCondition.get_func(condition_key)()
+        trials = TrialConditionMembership.get_trials(condition_key['trial_condition_name'])
 
-        unit_psth = (UnitPsth & {**condition_key, **unit_key}).fetch1()['unit_psth']
+        unit_psth = (UnitPsth & {**condition_key, **unit_key}
+                     & (psth_param_set_key or PsthParamSet.default_key())).fetch1()['unit_psth']
         if unit_psth is None:
             raise Exception('No spikes found for this unit and trial-condition')
 
@@ -438,28 +737,20 @@ class UnitSelectivity(dj.Computed):
         self.insert1({**key, 'unit_selectivity': pref})
 
 
-def compute_unit_psth(unit_key, trial_keys, per_trial=False):
+def compute_unit_psth(unit_key, trial_keys, per_trial=False, psth_params=None):
     """
     Compute unit-level psth for the specified unit and trial-set - return (time,)
     If per_trial == True, compute trial-level psth - return (trial#, time)
+    psth_params: dict(xmin, xmax, binsize) - UnitPsth.psth_params if None
     """
     q = (ephys.TrialSpikes & unit_key & trial_keys)
     if not q:
         return None
 
-    xmin, xmax, bin_size = UnitPsth.psth_params.values()
-    binning = np.arange(xmin, xmax, bin_size)
-
-    spikes = q.fetch('spike_times')
-
-    if per_trial:
-        trial_psth = np.vstack(np.histogram(spike, bins=binning)[0] / bin_size for spike in spikes)
-        return trial_psth, binning[1:]
-    else:
-        spikes = np.concatenate(spikes)
-        psth, edges = np.histogram(spikes, bins=binning)
-        psth = psth / len(q) / bin_size
-        return psth, edges[1:]
+    xmin, xmax, bin_size = (psth_params or UnitPsth.psth_params).values()
+    psth, edges = compute_psths(RaggedSpikes.from_rows(q.fetch('spike_times')), xmin, xmax, bin_size,
+                                per_trial=per_trial)
+    return psth, edges[1:]
 
 
 def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
@@ -506,10 +797,10 @@ def compute_CD_projected_psth(units, time_period=None):
 
     # -- the computation part
     # get units and trials - ensuring they have trial-spikes
-    contra_trials = (TrialCondition().get_trials(
+    contra_trials = (TrialConditionMembership.get_trials(
         'good_noearlylick_right_hit' if unit_hemi == 'left' else 'good_noearlylick_left_hit')
                      & session_key & ephys.TrialSpikes).fetch('KEY')
-    ipsi_trials = (TrialCondition().get_trials(
+    ipsi_trials = (TrialConditionMembership.get_trials(
         'good_noearlylick_left_hit' if unit_hemi == 'left' else 'good_noearlylick_right_hit')
                      & session_key & ephys.TrialSpikes).fetch('KEY')
 
@@ -0,0 +1,77 @@
+"""
+PSTH engine: binning of ragged spike times (trials, unit-trials) in single searchsorted/bincount passes -
+used by psth.UnitPsth and the psth helpers of psth.py
+"""
+from collections import namedtuple
+
+import numpy as np
+
+
+class RaggedSpikes(namedtuple('RaggedSpikes', ['offsets', 'values'])):
+    """
+    Spike times of many rows (trials, unit-trials) in one array - row i is values[offsets[i]:offsets[i + 1]]
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_rows(cls, rows):
+        lengths = np.array([len(row) for row in rows], dtype=int)
+        values = np.concatenate(rows).astype(float) if len(rows) else np.array([])
+        return cls(np.r_[0, np.cumsum(lengths)], values)
+
+    @property
+    def row_count(self):
+        return len(self.offsets) - 1
+
+    def row_index(self):
+        """
+        :return: row of each spike
+        """
+        return np.repeat(np.arange(self.row_count), np.diff(self.offsets))
+
+
+_bin_edges = {}
+
+
+def psth_bin_edges(xmin, xmax, binsize):
+    """
+    Bin edges of a psth parameter set - computed once per parameter set, read-only
+    """
+    params = (xmin, xmax, binsize)
+    if params not in _bin_edges:
+        edges = np.arange(xmin, xmax, binsize)
+        edges.flags.writeable = False
+        _bin_edges[params] = edges
+    return _bin_edges[params]
+
+
+def bin_spikes(spikes, edges):
+    """
+    Bin the RaggedSpikes `spikes` - as np.histogram: [left, right) bins, the last one closed
+    :return: row index, bin index - of the spikes within the edges
+    """
+    nbins = len(edges) - 1
+    bins = np.searchsorted(edges, spikes.values, side='right') - 1
+    bins[spikes.values == edges[-1]] = nbins - 1
+    in_range = (bins >= 0) & (bins < nbins)
+    return spikes.row_index()[in_range], bins[in_range]
+
+
+def spike_histograms(rows, bins, nbins, row_count):
+    """
+    Spike counts per row and bin, in one bincount pass - e.g. rows mapped to units to sum the trials of each unit
+    :return: (row_count, nbins) array
+    """
+    return np.bincount(rows * nbins + bins, minlength=row_count * nbins).reshape(row_count, nbins)
+
+
+def compute_psths(spikes, xmin, xmax, binsize, per_trial=False):
+    """
+    PSTH (spikes/s) of the RaggedSpikes `spikes`, one row per trial
+    :return: (trial#, time) psths if `per_trial`, else the trial-averaged psth (time,) - and the bin edges
+    """
+    edges = psth_bin_edges(xmin, xmax, binsize)
+    rows, bins = bin_spikes(spikes, edges)
+    counts = spike_histograms(rows, bins, len(edges) - 1, spikes.row_count)
+    psth = counts / binsize if per_trial else counts.sum(axis=0) / spikes.row_count / binsize
+    return psth, edges